@@ -7,6 +7,9 @@ from starlette.middleware.cors import CORSMiddleware
 
 import json # For data operations
 import datetime # For creating timestamps and datetime object conversions
+import time # For kafka sleep
+import random
+from array import array # Compact storage for the offset index
 
 import yaml # For using the yaml config file (app_conf)
 
@@ -17,15 +20,22 @@ import logging.config
 # For message brokering
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
 
 # Threading
-from threading import Thread
+from threading import Thread, Lock
+
+# Heartbeats to the monitors (shared with the other services)
+from common.heartbeat import setup_heartbeat_thread
 
 
 # Setting app configurations
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
+# Heartbeats to the monitors (optional - for health/check in heartbeat monitor mode)
+HEARTBEAT_ENABLED = app_config['heartbeat']['enabled']
+
 # Logging configurations
 with open("config/log_conf.yaml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -34,89 +44,325 @@ with open("config/log_conf.yaml", "r") as f:
 logger = logging.getLogger('basicLogger')
 
 HOSTNAME = f"{app_config['events']['hostname']}:{app_config['events']['port']}" # kafka:9092
+FETCH_TIMEOUT_MS = app_config['events']['fetch_timeout_ms'] # How long to wait when fetching a single message
+SAMPLE_SIZE = app_config['events']['sample_size'] # Readings kept per event type for /hair/{type}/sample
+
+
+# Message brokering
+# Create class for managing Kafka connections (client, tailing consumer, and single message fetches)
+class KafkaWrapper:
+    def __init__(self, hostname, topic):
+        self.hostname = hostname
+        self.topic = topic
+        self.client = None
+        self.consumer = None
+        self.fetch_consumers = {} # Partition id -> consumer used for fetching single messages
+        self.fetch_lock = Lock() # Fetch consumers are shared between API requests
+        self.connect()
+
+
+    # Infinitely attempt to create a working client and consumer
+    def connect(self):
+        """Infinite loop: will keep trying"""
+
+        while True: # Try until successful
+            logger.debug("Trying to connect to Kafka...")
+            if self.make_client(): # Tries to make a Kafka client
+                if self.make_consumer(): # Tries to make a Kafka consumer
+                    # If client and consumer successfully created/already existing, stop trying to create them
+                    break
+            # Sleeps for a random amount of time (0.5 to 1.5s)
+            time.sleep(random.randint(500, 1500) / 1000)
+
+
+    def reset(self):
+        """Forget the saved client and consumers so connect() makes new ones"""
+
+        self.client = None
+        self.consumer = None
+        with self.fetch_lock:
+            self.fetch_consumers = {}
+
+
+    def make_client(self):
+        """
+        Runs once, makes a client and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+
+        if self.client is not None: # if client already exists, don't make one
+            return True
+
+        try:
+            # Make client and save it in self.client
+            self.client = KafkaClient(hosts=self.hostname)
+            logger.info("Kafka client created!")
+            return True
+        except KafkaException as e:
+            msg = f"Kafka error when making client: {e}"
+            logger.warning(msg)
+            self.reset()
+            return False
+
+
+    def make_consumer(self):
+        """
+        Runs once, makes a consumer that tails the topic from the beginning and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+
+        if self.consumer is not None:
+            return True # if consumer already exists, don't make one
+        if self.client is None:
+            return False # Don't try to create consumer if client doesn't exist
+
+        try:
+            topic = self.client.topics[self.topic]
+            self.consumer = topic.get_simple_consumer(
+                reset_offset_on_start=True, # Read the whole history once on start...
+                auto_offset_reset=OffsetType.EARLIEST # ...then keep following new messages
+            )
+            return True
+        except KafkaException as e: # Will be triggered if Kafka is down
+            msg = f"Make error when making consumer: {e}"
+            logger.warning(msg)
+            self.reset()
+            return False # connect() will retry
+
+
+    def messages(self):
+        """Generator method that catches exceptions in the consumer loop"""
+
+        if self.consumer is None:
+            self.connect() # Try to create/reconnect client and consumer
+
+        while True: # Runs infinitely
+            try:
+                for msg in self.consumer:
+                    yield msg # To be used in process_messages()
+            # If any error occurs, keep trying
+            except KafkaException as e:
+                # Reset client and consumer and attempt to reconnect
+                msg = f"Kafka issue in comsumer: {e}"
+                logger.warning(msg)
+                self.reset()
+                self.connect()
+
+
+    def fetch(self, partition_id, offset):
+        """
+        Fetches the single message at an offset in a partition.
+        Returns: message (success), None (message couldn't be fetched)
+        """
+
+        if self.client is None:
+            return None # Reconnecting to Kafka
+
+        with self.fetch_lock:
+            try:
+                if partition_id not in self.fetch_consumers:
+                    topic = self.client.topics[self.topic]
+                    # Consumer that only reads from this partition
+                    self.fetch_consumers[partition_id] = topic.get_simple_consumer(
+                        partitions=[topic.partitions[partition_id]],
+                        consumer_timeout_ms=FETCH_TIMEOUT_MS,
+                        queued_max_messages=1 # Only ever need one message
+                    )
+                consumer = self.fetch_consumers[partition_id]
+                partition = consumer.partitions[partition_id]
+                # Position the consumer just before the message
+                    # (Earliest if the message is the first one in the partition)
+                consumer.reset_offsets([(partition, offset - 1 if offset > 0 else OffsetType.EARLIEST)])
+                while True:
+                    msg = consumer.consume(block=True)
+                    if msg is None or msg.offset > offset:
+                        return None # Timed out or message no longer exists
+                    if msg.offset == offset:
+                        return msg
+            except KafkaException as e:
+                logger.warning(f"Kafka issue when fetching message {offset} from partition {partition_id}: {e}")
+                self.fetch_consumers.pop(partition_id, None)
+                return None
+
+
+# Index from event type to the (partition, offset) of every message of that type
+    # Updated by the tailing consumer in process_messages()
+class EventIndex:
+    def __init__(self, event_types):
+        self.lock = Lock()
+        self.partitions = { event_type: array('i') for event_type in event_types }
+        self.offsets = { event_type: array('q') for event_type in event_types }
+        self.last_offsets = {} # Partition id -> last offset indexed (skips messages re-read after reconnecting)
+        self.num_messages = 0 # All messages seen, including unknown event types
+
+
+    def add(self, event_type, partition_id, offset):
+        """
+        Add a message to the index - messages that are already indexed are ignored.
+        Returns: True (message is new), False (already indexed)
+        """
+
+        with self.lock:
+            if offset <= self.last_offsets.get(partition_id, -1):
+                return False
+            self.last_offsets[partition_id] = offset
+            self.num_messages += 1
+            if event_type in self.offsets:
+                self.partitions[event_type].append(partition_id)
+                self.offsets[event_type].append(offset)
+            return True
+
+
+    def get(self, event_type, index):
+        """
+        Gets the location of the message at an index for an event type.
+        Returns: (partition id, offset) (found), None (index out of range)
+        """
+
+        with self.lock:
+            if index < 0 or index >= len(self.offsets[event_type]):
+                return None
+            return self.partitions[event_type][index], self.offsets[event_type][index]
+
+
+    def stats(self):
+        """
+        Gets a consistent snapshot of the counters.
+        Returns: (count per event type, total messages, last offset per partition)
+        """
+
+        with self.lock:
+            counts = { event_type: len(offsets) for event_type, offsets in self.offsets.items() }
+            return counts, self.num_messages, dict(self.last_offsets)
+
+
+# The most recent readings of one event type, to pick a random one from
+    # Fixed number of slots reused in a circle (the newest reading replaces the oldest), so memory stays at `size` readings
+    # and the sample follows the topic instead of drifting toward old history
+    # Updated by the tailing consumer in process_messages()
+class RecentSample:
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+        self.readings = [] # Payloads
+        self.next_slot = 0 # Slot the next reading replaces once the sample is full (the oldest one)
+
+
+    def add(self, reading):
+        with self.lock:
+            if len(self.readings) < self.size:
+                self.readings.append(reading)
+            else:
+                self.readings[self.next_slot] = reading
+                self.next_slot = (self.next_slot + 1) % self.size
 
 
-def get_hair_volume_reading(index):
-    client = KafkaClient(hosts=HOSTNAME)
-    topic = client.topics[str.encode(f"{app_config['events']['topic']}")]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    def pick(self):
+        """
+        Picks one reading from the sample at random.
+        Returns: payload (success), None (no readings yet)
+        """
+
+        with self.lock:
+            if not self.readings:
+                return None
+            return random.choice(self.readings)
 
-    message_count = 0 # Keeping track of how many messages are in the message queue
-    reading_count = 0 # For keeping track of the records pertaining to this event
 
-    for msg in consumer:
+event_index = EventIndex(["volume_reading", "type_reading"])
+samples = { event_type: RecentSample(SAMPLE_SIZE) for event_type in ["volume_reading", "type_reading"] }
+kafka_wrapper = None # Created in setup_kafka_thread()
+
+
+def process_messages():
+    """ Tail the topic, index every message and sample the readings using KafkaWrapper"""
+    global kafka_wrapper
+    kafka_wrapper = KafkaWrapper(HOSTNAME, str.encode(app_config['events']['topic']))
+
+    for msg in kafka_wrapper.messages():
         msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        # logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        if msg["type"] == "volume_reading":
-            if reading_count == index:
-                logger.info(f"Returning volume_reading at index {index}.")
-                logger.info(f"(Message {message_count}) Index {index} type_reading payload: {payload}")
-                return payload, 200
-            else:
-                reading_count += 1 # Next volume reading will be of index 1 (for its event type)
-        message_count += 1 # Increment total number of messages
+        event = json.loads(msg_str)
+        # Messages re-read after reconnecting were already sampled
+        if event_index.add(event["type"], msg.partition_id, msg.offset) and event["type"] in samples:
+            samples[event["type"]].add(event["payload"])
+
+
+def get_reading_at_index(event_type, index):
+    """
+    Looks up a reading in the index and fetches its message from Kafka.
+    Returns: payload (found), None (not found)
+    """
+    location = event_index.get(event_type, index)
+    if location is None or kafka_wrapper is None:
+        return None
+
+    partition_id, offset = location
+    msg = kafka_wrapper.fetch(partition_id, offset)
+    if msg is None:
+        return None
+
+    msg_str = msg.value.decode('utf-8')
+    logger.info(f"(Partition {partition_id}, offset {offset}) Index {index} {event_type} message: {msg_str}")
+    return json.loads(msg_str)["payload"]
+
+
+def get_hair_volume_reading(index):
+    payload = get_reading_at_index("volume_reading", index)
+    if payload is not None:
+        logger.info(f"Returning volume_reading at index {index}.")
+        return payload, 200
 
     logger.info(f"No volume_reading at index {index} was found.")
     return { "message": f"No volume_event at index {index}!"}, 404
 
 
 def get_hair_type_reading(index):
-    client = KafkaClient(hosts=HOSTNAME)
-    topic = client.topics[str.encode(f"{app_config['events']['topic']}")]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-
-    message_count = 0 # Keeping track of how many messages are in the message queue
-    reading_count = 0 # For keeping track of the records pertaining to this event
-
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        # logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        if msg["type"] == "type_reading":
-            if reading_count == index:
-                logger.info(f"Returning type_reading at index {index}.")
-                logger.info(f"(Message {message_count}) Index {index} type_reading payload: {payload}")
-                return payload, 200
-            else:
-                reading_count += 1 # Next type reading will be of index 1 (for its event type)
-        message_count += 1 # Increment total number of messages
+    payload = get_reading_at_index("type_reading", index)
+    if payload is not None:
+        logger.info(f"Returning type_reading at index {index}.")
+        return payload, 200
 
     logger.info(f"No type_reading at index {index} was found.")
     return { "message": f"No type_reading event at index {index}!"}, 404
 
 
-def get_reading_stats():
-    logger.info("GET request to '/stats' was received.")
+def get_hair_volume_sample():
+    # Served from memory - nothing is read from Kafka
+    payload = samples["volume_reading"].pick()
+    if payload is not None:
+        logger.info("Returning a sampled volume_reading.")
+        return payload, 200
 
-    client = KafkaClient(hosts=HOSTNAME)
-    topic = client.topics[str.encode(f"{app_config['events']['topic']}")]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    logger.info("No volume_reading has been sampled yet.")
+    return { "message": "No volume_reading event has been received yet!"}, 404
 
-    message_count = 0
-    # Tracking number of readings for each event type
-    volume_readings_count = 0
-    type_readings_count = 0
 
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message %i: %s" % (message_count, msg))
-        if msg["type"] == "volume_reading":
-            volume_readings_count += 1
-        elif msg["type"] == "type_reading":
-            type_readings_count += 1
-        message_count += 1
+def get_hair_type_sample():
+    # Served from memory - nothing is read from Kafka
+    payload = samples["type_reading"].pick()
+    if payload is not None:
+        logger.info("Returning a sampled type_reading.")
+        return payload, 200
+
+    logger.info("No type_reading has been sampled yet.")
+    return { "message": "No type_reading event has been received yet!"}, 404
+
+
+def get_reading_stats():
+    logger.info("GET request to '/stats' was received.")
+
+    # Counts are kept up to date by the tailing consumer, so nothing is read from Kafka here
+    counts, num_messages, last_offsets = event_index.stats()
 
     stats = {
-        "num_volume_readings": volume_readings_count,
-        "num_type_readings": type_readings_count
+        "num_volume_readings": counts["volume_reading"],
+        "num_type_readings": counts["type_reading"],
+        "num_messages": num_messages,
+        # How current the counts are - last offset consumed in each partition
+        "last_offsets": { str(partition_id): offset for partition_id, offset in last_offsets.items() }
     }
 
     logger.debug(f"stats contents:\n{stats}")
-    logger.info("GET request to '/stats' was received.")
     return stats, 200
 
 
@@ -126,6 +372,18 @@ def get_health():
     return {"status": "Running"}, 200 # If service is running, then it will return 200 which means it's ok
 
 
+def setup_kafka_thread():
+    t1 = Thread(target=process_messages)
+    t1.setDaemon(True)
+    t1.start()
+
+
+def get_heartbeat_counters():
+    counts, _, _ = event_index.stats()
+    # Same fields as /stats
+    return { "num_volume_readings": counts["volume_reading"], "num_type_readings": counts["type_reading"] }
+
+
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("config/hair-api-1.0.0-swagger.yaml", strict_validation=True, validate_responses=True)
 
@@ -140,4 +398,7 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    setup_kafka_thread()
+    if HEARTBEAT_ENABLED:
+        setup_heartbeat_thread("analyzer", get_heartbeat_counters, app_config['heartbeat'])
     app.run(port=8110, host="0.0.0.0") # Analyzer is running on port 8110
\ No newline at end of file
@@ -1,5 +1,6 @@
 import connexion
 from connexion import NoContent
+from connexion import request # For reading the conditional GET headers
 
 # Disabling CORS
 from connexion.middleware import MiddlewarePosition
@@ -9,6 +10,11 @@ import os.path # For reading and writing to files
 import json # For data operations
 from datetime import datetime, timezone # For creating and formatting timestamps and converting timezones 
 
+import asyncio # For checking every instance at the same time
+import socket # For finding a service's instances from DNS
+import hashlib # For status ETags
+from email.utils import format_datetime, parsedate_to_datetime # For Last-Modified/If-Modified-Since headers
+
 import yaml # For using the yaml config file (app_conf)
 import httpx # For sending get requests to services to check their health
 
@@ -19,21 +25,28 @@ import logging.config
 # Scheduling
 from apscheduler.schedulers.background import BackgroundScheduler 
 
+# Threading
+from threading import Thread, Lock
+
+# Heartbeats pushed by the services (heartbeat monitor mode)
+from common.heartbeat_registry import HeartbeatRegistry
+
 
 # Setting app configurations
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
-STORAGE_URL = app_config['eventstores']['storage']['url']
-RECEIVER_URL = app_config['eventstores']['receiver']['url']
-PROCESSING_URL = app_config['eventstores']['processing']['url']
-ANALYZER_URL = app_config['eventstores']['analyzer']['url']
 TIMEOUT = app_config['timeout']['interval']
 
 DATASTORE_FILE = app_config['datastore']['filename']
 
 SERVICES = app_config['eventstores']
 
+# 'poll' checks every instance on the scheduler interval, 'heartbeat' uses the heartbeats the services push to /heartbeat
+MONITOR_MODE = app_config['monitor']['mode']
+HEARTBEAT_TTL = app_config['monitor']['ttl'] # Seconds an instance counts as available after its last heartbeat
+HEARTBEAT_FORGET_AFTER = app_config['monitor']['forget_after'] # Seconds before a silent instance is dropped
+
 # Setting logging configurations
 with open("config/log_conf.yaml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -61,8 +74,11 @@ def get_file_contents(filename):
     return content
 
 def write_to_file(filename, content):
-    with open(filename, 'w') as my_file: # 'w' to write - will overwrite file if there's anything there already
-        my_file.write(json.dumps(content, indent=4)) # Convert python dict into json (indent for formatting)
+    # Written to a temp file and renamed over the old one, so readers never see a half-written file
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w') as my_file:
+        my_file.write(json.dumps(content, separators=(',', ':'))) # Compact - the file is only read by this service
+    os.replace(temp_filename, filename) # Atomic on the same filesystem
 
 
 def create_dummy_statuses():
@@ -77,26 +93,274 @@ def create_dummy_statuses():
     return dummy_statuses
 
 
+# In-memory status messages
+    # Updated by check_services() (and by /check itself in heartbeat mode) and served straight from memory
+    # The status file is only read at startup and written when a message changes (see set_status_messages)
+status_lock = Lock()
+current_messages = None # Set by load_status_messages()
+messages_values = None # Compact JSON of the messages, for spotting changes
+messages_persisted = None # Compact JSON of the messages last written to the status file
+messages_etag = None
+messages_last_modified = None # When the messages last changed (UTC datetime)
+
+
+def make_messages_values(status_messages):
+    return json.dumps(status_messages, separators=(',', ':'), sort_keys=True)
+
+
+def make_etag(values):
+    ''' Returns: quoted hash of the compact JSON of the status messages '''
+    return f'"{hashlib.sha1(values.encode("utf-8")).hexdigest()}"'
+
+
+def load_status_messages():
+    ''' Loads the last saved status messages from the status file (or dummy statuses) into memory '''
+    global current_messages, messages_values, messages_persisted, messages_etag, messages_last_modified
+
+    status_messages = {}
+    if does_file_exist(DATASTORE_FILE) and os.path.getsize(DATASTORE_FILE) > 0:
+        status_messages = get_file_contents(DATASTORE_FILE)
+    if not status_messages:
+        status_messages = create_dummy_statuses()
+
+    with status_lock:
+        current_messages = status_messages
+        messages_values = make_messages_values(status_messages)
+        messages_persisted = messages_values
+        messages_etag = make_etag(messages_values)
+        messages_last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def get_current_messages():
+    ''' Returns: copy of the in-memory status messages (to update and pass to set_status_messages) '''
+    with status_lock:
+        return json.loads(json.dumps(current_messages))
+
+
+def set_status_messages(status_messages, persist=True):
+    '''
+        Replaces the in-memory status messages if they changed
+            persist: also save them to the status file if they're different from what it holds
+
+        Returns:
+            True (changed), False (unchanged)
+    '''
+    global current_messages, messages_values, messages_persisted, messages_etag, messages_last_modified
+
+    values = make_messages_values(status_messages)
+    with status_lock:
+        changed = values != messages_values
+        if changed:
+            current_messages = status_messages
+            messages_values = values
+            messages_etag = make_etag(values)
+            messages_last_modified = datetime.now(timezone.utc).replace(microsecond=0) # HTTP dates only have whole seconds
+        if persist and values != messages_persisted:
+            # Written while holding the lock so an older version can't be renamed over a newer one
+            write_to_file(DATASTORE_FILE, status_messages)
+            messages_persisted = values
+    return changed
+
+
+def is_not_modified(etag, last_modified):
+    ''' Checks the conditional GET headers - If-None-Match is used over If-Modified-Since when both are sent '''
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak validators (W/"...") compare the same as strong ones for GET
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError): # Invalid date, or one without a timezone
+            return False
+    return False
+
+
     # Called through /check endpoint
+    # Sends ETag/Last-Modified, and 304 with no body if the client already has the current messages
 def get_checks():
     ''' 
-        Checks status messages from backend services from the status file
+        Checks status messages from backend services
         
         Returns:
             dict (String) Status message of each service
     '''
     logger.info("GET request to '/check' was received.")
-    # If file doesn't exist, return nothing with status code 404
-    if not os.path.isfile(DATASTORE_FILE):
-        logger.error(f"Status messages do not exist. File: '{DATASTORE_FILE}' could not be found.")
-        return NoContent, 404
-    # If file exists, return dict version of status messages with status code 200
+
+    # Heartbeats are checked when asked, so a service is shown as unavailable as soon as its heartbeats expire
+        # The counters in the messages move with every heartbeat, so they're only updated in memory here
+        # The file is written by check_services() each interval, or straight away if an instance became (un)available
+    if MONITOR_MODE == 'heartbeat':
+        status_messages = get_current_messages()
+        update_status_messages(status_messages, get_heartbeat_messages())
+        with status_lock:
+            availability_changed = status_messages["instances"] != current_messages.get("instances")
+        set_status_messages(status_messages, persist=availability_changed)
+
+    with status_lock:
+        status_messages = current_messages # Replaced (never changed) by set_status_messages, so safe to return
+        etag = messages_etag
+        last_modified = messages_last_modified
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache" # Browsers check with the ETag each time instead of guessing how long to cache for
+    }
+    if is_not_modified(etag, last_modified):
+        return NoContent, 304, headers
+
+    logger.debug(f"Status messages:\n{status_messages}")
+    return status_messages, 200, headers
+
+
+# Heartbeats (heartbeat monitor mode)
+heartbeat_registry = HeartbeatRegistry(HEARTBEAT_TTL, HEARTBEAT_FORGET_AFTER)
+
+
+# POST Endpoint function for receiving heartbeats from backend services
+    # Called through /heartbeat endpoint
+def post_heartbeat(body):
+    ''' 
+        Records a heartbeat (with the service's counters) from an instance of a backend service
+
+        Returns:
+            204 (recorded), 400 (unknown service)
+    '''
+    if body['service'] not in SERVICES:
+        return { "message": f"Unknown service: {body['service']}" }, 400
+    heartbeat_registry.beat(body['service'], body['instance'], body.get('counters', {}))
+    return NoContent, 204
+
+
+def get_heartbeat_messages():
+    ''' Returns: dict of service name -> list of status messages (None for each instance whose heartbeats expired) '''
+    messages = {}
+    for service_name in SERVICES:
+        alive, num_instances = heartbeat_registry.get_instances(service_name)
+        messages[service_name] = [None] * (num_instances - len(alive))
+        for heartbeat in alive:
+            try:
+                messages[service_name].append(make_status_message(service_name, heartbeat['counters']))
+            except KeyError:
+                logger.info(f"{service_name} instance {heartbeat['instance']} sent a heartbeat without the expected counters")
+                messages[service_name].append(None)
+    return messages
+
+
+# Checking instances (poll monitor mode)
+    # Checks run on one event loop in a background thread, sharing a single async client (and its connections) between runs
+check_loop = asyncio.new_event_loop()
+check_client = httpx.AsyncClient(timeout=TIMEOUT)
+
+
+def run_check_loop():
+    asyncio.set_event_loop(check_loop)
+    check_loop.run_forever()
+
+
+def setup_check_thread():
+    t1 = Thread(target=run_check_loop)
+    t1.daemon = True
+    t1.start()
+
+
+async def resolve_instances(service_name, service_info):
+    '''
+        Finds the URLs of every instance of a service. Each service in the config has one of:
+            url: one instance
+            urls: list of instances
+            dns: {host, port, path} - one instance per address the host resolves to (e.g. every replica of a compose service)
+
+        Returns:
+            list: instance URLs (empty if DNS lookup failed)
+    '''
+    if 'urls' in service_info:
+        return service_info['urls']
+    if 'dns' not in service_info:
+        return [service_info['url']]
+
+    dns = service_info['dns']
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(dns['host'], dns['port'], type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        logger.info(f"{service_name} could not be resolved: {e}")
+        return []
+    hosts = sorted({ address[4][0] for address in addresses })
+    return [f"http://{host}:{dns['port']}{dns['path']}" for host in hosts]
+
+
+def make_status_message(service_name, response_json):
+    if service_name == "storage":
+        return f"{service_name} has {response_json['num_vol']} Volume and {response_json['num_type']} Type readings in the database"
+    elif service_name == "analyzer":
+        return f"{service_name} has {response_json['num_volume_readings']} Volume and {response_json['num_type_readings']} Type readings in the datastore file" 
+    elif service_name == "processing":
+        return f"{service_name} has {response_json['num_vol_readings']} Volume and {response_json['num_type_readings']} Type readings in the datastore file"
     else:
-        # Read from file
-        status_messages = get_file_contents(DATASTORE_FILE)
-        logger.debug(f"Status file contents:\n{status_messages}")
-        logger.info("GET request to '/check' was received.")
-        return status_messages, 200
+        return f"{service_name} is healthy at {response_json['status_datetime']}"
+
+
+async def check_instance(service_name, url):
+    '''
+        Returns:
+            str: status message (instance available), None (instance not available)
+    '''
+    try:
+        response = await check_client.get(url)
+        if response.status_code == 200:
+            return make_status_message(service_name, response.json())
+        logger.info(f"{service_name} at {url} returning non-200 response")
+    except Exception as e:
+        logger.info(f"{service_name} at {url} is Not Available: {e!r}")
+    return None
+
+
+async def check_all_instances():
+    ''' Returns: dict of service name -> list of status messages (None for each unavailable instance) '''
+    instances = await asyncio.gather(*[
+        resolve_instances(service_name, service_info) for service_name, service_info in SERVICES.items()
+    ])
+    checks = [
+        [check_instance(service_name, url) for url in urls]
+        for service_name, urls in zip(SERVICES, instances)
+    ]
+    # Every instance of every service at the same time
+    results = await asyncio.gather(*[check for service_checks in checks for check in service_checks])
+
+    messages = {}
+    for service_name, service_checks in zip(SERVICES, checks):
+        messages[service_name] = results[:len(service_checks)]
+        results = results[len(service_checks):]
+    return messages
+
+
+def update_status_messages(status_messages, results):
+    ''' Sets each service's message and the availability counts from a list of messages per service (None = unavailable instance) '''
+    num_services_available = 0
+    num_instances_available = 0
+    status_messages["instances"] = {}
+    for service_name, instance_messages in results.items():
+        available_messages = [message for message in instance_messages if message is not None]
+        status_messages["instances"][service_name] = {
+            "available": len(available_messages),
+            "total": len(instance_messages)
+        }
+        num_instances_available += len(available_messages)
+
+        if available_messages:
+            num_services_available += 1
+            logger.info(f"{service_name} is Healthy ({len(available_messages)}/{len(instance_messages)} instances)")
+            status_messages[service_name] = available_messages[0] # Any instance's message will do
+        else:
+            logger.info(f"{service_name} is Not Available")
+            status_messages[service_name] = "Unavailable"
+
+    status_messages["services_available"] = num_services_available
+    status_messages["instances_available"] = num_instances_available
 
 
 # Updates status messages in the statuses file
@@ -104,55 +368,27 @@ def get_checks():
     # Constantly running in background
 def check_services():
     ''' 
-        Updates status messages in the status file based on GET requests to an endpoint for each service
+        Updates the status messages based on GET requests to an endpoint for each instance of each service
 
         Returns:
             int: Number of available services
     '''
     logger.info("Periodic status checking has started.")
 
-    # Check if datastore file exists, create file if it doesn't
-    if does_file_exist(DATASTORE_FILE):
-        # If file is empty, populate with dummy statuses
-        if os.path.getsize(DATASTORE_FILE) == 0:
-            dummy_statuses = create_dummy_statuses()
-            write_to_file(DATASTORE_FILE, dummy_statuses)
-
-    # Update dict received from the datastore file and then overwrite file
-    status_messages = get_file_contents(DATASTORE_FILE)
+    # Update a copy of the in-memory status messages
+    status_messages = get_current_messages()
 
-    # Handling service health GET endpoints and statuses
-        # Retrieving service name and the dictionary of variables nested under it (just URL for now)
-    for service_name, service_info in SERVICES.items():
-        num_available = 0
-
-        service_status = "Unavailable"
-        try:
-            response = httpx.get(service_info['url'], timeout=TIMEOUT)
-            if response.status_code == 200:
-                response_json = response.json()
-                if service_name == "storage":
-                    status_message = f"{service_name} has {response_json['num_vol']} Volume and {response_json['num_type']} Type readings in the database"
-                elif service_name == "analyzer":
-                    status_message = f"{service_name} has {response_json['num_volume_readings']} Volume and {response_json['num_type_readings']} Type readings in the datastore file" 
-                elif service_name == "processing":
-                    status_message = f"{service_name} has {response_json['num_vol_readings']} Volume and {response_json['num_type_readings']} Type readings in the datastore file"
-                else:
-                    status_message = f"{service_name} is healthy at {response_json['status_datetime']}"
-                num_available += 1
-                logger.info(f"{service_name} is Healthy")
-                status_messages[service_name] = status_message
-                status_messages["services_available"] = num_available
-            else:
-                logger.info(f"{service_name} returning non-200 response")
-        except Exception as e:
-            logger.info(f"{service_name} is Not Available")
-    
-
-    # Overwrite content in file
-    write_to_file(DATASTORE_FILE, status_messages)
+    # Services push heartbeats, so nothing needs to be requested
+    if MONITOR_MODE == 'heartbeat':
+        results = get_heartbeat_messages()
+    # Handling service endpoints and statuses
+    else:
+        results = asyncio.run_coroutine_threadsafe(check_all_instances(), check_loop).result()
+    update_status_messages(status_messages, results)
 
-    logger.debug(f"New status messages:\n{status_messages}")
+    # Saved to file only if something changed
+    if set_status_messages(status_messages):
+        logger.debug(f"New status messages:\n{status_messages}")
 
     logger.info("Periodic status checking has ended.")
 
@@ -181,5 +417,8 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    load_status_messages()
+    if MONITOR_MODE == 'poll':
+        setup_check_thread()
     init_scheduler()
     app.run(port=8130, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,47 @@
+'''
+    Heartbeats to the monitors (health and check in heartbeat monitor mode)
+        Shared by every service that sends them - mounted into each container at /app/common (see docker-compose.yml)
+'''
+import time
+import socket # For identifying this instance in heartbeats
+import logging
+from threading import Thread
+
+import httpx # For sending heartbeats
+
+logger = logging.getLogger('basicLogger')
+
+
+def send_heartbeats(service_name, get_counters, heartbeat_config):
+    """
+    Pushes this instance's counters to the monitors every heartbeat interval.
+    Infinite loop: a monitor being down only means it misses the heartbeat
+    """
+    instance_id = socket.gethostname() # Container id, so each replica is its own instance
+    with httpx.Client(timeout=heartbeat_config['timeout']) as client:
+        while True: # Runs infinitely
+            try:
+                heartbeat = { "service": service_name, "instance": instance_id, "counters": get_counters() }
+            except Exception as e:
+                # No heartbeat while the counters can't be read, so the monitors see this instance as down
+                logger.warning(f"Couldn't get counters for heartbeat: {e}")
+                heartbeat = None
+
+            if heartbeat is not None:
+                for url in heartbeat_config['urls']:
+                    try:
+                        client.post(url, json=heartbeat)
+                    except httpx.HTTPError as e:
+                        logger.debug(f"Heartbeat to '{url}' failed: {e!r}")
+            time.sleep(heartbeat_config['interval'])
+
+
+def setup_heartbeat_thread(service_name, get_counters, heartbeat_config):
+    '''
+        service_name: name the monitors know the service by
+        get_counters: returns the dict of counters sent with each heartbeat
+        heartbeat_config: the service's heartbeat settings (interval, timeout, urls)
+    '''
+    t_heartbeat = Thread(target=send_heartbeats, args=(service_name, get_counters, heartbeat_config))
+    t_heartbeat.daemon = True
+    t_heartbeat.start()
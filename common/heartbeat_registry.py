@@ -0,0 +1,45 @@
+'''
+    Registry of the heartbeats the services push to the monitors (health and check in heartbeat monitor mode)
+        Shared by both monitors - mounted into each container at /app/common (see docker-compose.yml)
+'''
+import time # For heartbeat expiry
+from datetime import datetime, timezone # For the time each heartbeat was received
+from threading import Lock
+
+
+# In-memory registry of the latest heartbeat from each service instance
+    # An instance is alive until `ttl` seconds after its last heartbeat
+    # Instances that stop sending for `forget_after` seconds (e.g. removed replicas) are dropped
+class HeartbeatRegistry:
+    def __init__(self, ttl, forget_after):
+        self.ttl = ttl
+        self.forget_after = forget_after
+        self.lock = Lock()
+        self.heartbeats = {} # (service name, instance id) -> last heartbeat
+
+
+    def beat(self, service_name, instance_id, counters):
+        """Records a heartbeat - replaces the instance's previous one, so it's the same work no matter how many instances there are"""
+        with self.lock:
+            self.heartbeats[(service_name, instance_id)] = {
+                'instance': instance_id,
+                'counters': counters, # The service's own counters (same fields as its /stats or /check response)
+                'received': time.monotonic(),
+                'received_at': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            }
+
+
+    def get_instances(self, service_name):
+        """
+        Gets the heartbeats of a service's instances.
+        Returns: (list of alive instances' heartbeats, newest first, number of instances known)
+        """
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, heartbeat in self.heartbeats.items() if now - heartbeat['received'] > self.forget_after]:
+                del self.heartbeats[key]
+
+            heartbeats = [heartbeat for (name, _), heartbeat in self.heartbeats.items() if name == service_name]
+            alive = [heartbeat for heartbeat in heartbeats if now - heartbeat['received'] <= self.ttl]
+        alive.sort(key=lambda heartbeat: heartbeat['received'], reverse=True)
+        return alive, len(heartbeats)
@@ -1,5 +1,6 @@
 import connexion
 from connexion import NoContent
+from connexion import request # For reading the conditional GET headers
 
 # Disabling CORS
 from connexion.middleware import MiddlewarePosition
@@ -9,6 +10,11 @@ import os.path # For reading and writing to files
 import json # For data operations
 from datetime import datetime, timezone # For creating and formatting timestamps and converting timezones 
 
+import time # For timing probes
+import asyncio # For probing every service at the same time
+import hashlib # For status ETags
+from email.utils import format_datetime, parsedate_to_datetime # For Last-Modified/If-Modified-Since headers
+
 import yaml # For using the yaml config file (app_conf)
 import httpx # For sending get requests to services to check their health
 
@@ -19,6 +25,16 @@ import logging.config
 # Scheduling
 from apscheduler.schedulers.background import BackgroundScheduler 
 
+# Threading
+from threading import Thread, Lock
+
+# Rolling probe latency per service
+from latency import LatencyHistogram
+# Heartbeats pushed by the services (heartbeat monitor mode)
+from common.heartbeat_registry import HeartbeatRegistry
+# Dashboard snapshots shared by every viewer
+from dashboard import DashboardCache
+
 # Setting app configurations
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -35,6 +51,19 @@ READ_TIMEOUT_INTERVAL = app_config['timeouts']['read']['interval']
 
 SERVICES = app_config['eventstores']
 
+LATENCY_WINDOW = app_config['latency']['window'] # Probes per service kept in the latency histograms
+
+# 'poll' probes every service on the scheduler interval, 'heartbeat' uses the heartbeats the services push to /heartbeat
+MONITOR_MODE = app_config['monitor']['mode']
+HEARTBEAT_TTL = app_config['monitor']['ttl'] # Seconds an instance counts as running after its last heartbeat
+HEARTBEAT_FORGET_AFTER = app_config['monitor']['forget_after'] # Seconds before a silent instance is dropped
+
+# Dashboard snapshot settings
+DASHBOARD_TTL = app_config['dashboard']['ttl'] # Seconds a snapshot is reused before it's rebuilt
+DASHBOARD_TIMEOUT = app_config['dashboard']['timeout'] # Seconds to wait for each service when building a snapshot
+DASHBOARD_PROCESSING_STATS_URL = app_config['dashboard']['processing']['stats_url']
+DASHBOARD_ANALYZER_URLS = app_config['dashboard']['analyzer']
+
 # Setting logging configurations
 with open("config/log_conf.yaml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -62,8 +91,11 @@ def get_file_contents(filename):
     return content
 
 def write_to_file(filename, content):
-    with open(filename, 'w') as my_file: # 'w' to write - will overwrite file if there's anything there already
-        my_file.write(json.dumps(content, indent=4)) # Convert python dict into json (indent for formatting)
+    # Written to a temp file and renamed over the old one, so readers never see a half-written file
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w') as my_file:
+        my_file.write(json.dumps(content, separators=(',', ':'))) # Compact - the file is only read by this service
+    os.replace(temp_filename, filename) # Atomic on the same filesystem
 
 
 # Generating statuses from readings
@@ -81,33 +113,232 @@ def create_dummy_statuses():
         'processing': 'Down',
         'receiver': 'Down',
         'storage': 'Down',
-        'last_update': str_date_last_updated
+        'last_update': str_date_last_updated,
+        'last_success': {}, # Service name -> last time it responded as running
+        'latency': {} # Service name -> recent probe latencies (see LatencyHistogram.to_dict)
     }
     return dummy_statuses
 
 
+# In-memory statuses
+    # Updated by populate_statuses() (and by /statuses itself in heartbeat mode) and served straight from memory
+    # The statuses file is only read at startup and written when a service's status changes
+status_lock = Lock()
+current_statuses = None # Set by load_statuses()
+status_body = None # Compact JSON of the statuses, for spotting changes (and the ETag)
+persisted_values = None # Compact JSON of the service statuses last written to the statuses file
+status_etag = None
+status_last_modified = None # When the statuses last changed (UTC datetime)
+# Fields that move on every round (time of the round, probe latency, last successful probe)
+    # They're part of the ETag like the rest of the body, but are only saved to the statuses file along with a status change
+VOLATILE_FIELDS = ['last_update', 'last_success', 'latency']
+
+
+def make_status_body(statuses):
+    return json.dumps(statuses, separators=(',', ':'), sort_keys=True)
+
+
+def make_status_values(statuses):
+    return json.dumps(
+        { key: value for key, value in statuses.items() if key not in VOLATILE_FIELDS },
+        separators=(',', ':'),
+        sort_keys=True
+    )
+
+
+def make_etag(body):
+    ''' Returns: quoted hash of the compact JSON of the statuses '''
+    return f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"'
+
+
+def load_statuses():
+    ''' Loads the last saved statuses from the statuses file (or dummy statuses) into memory '''
+    global current_statuses, status_body, persisted_values, status_etag, status_last_modified
+
+    statuses = {}
+    if does_file_exist(DATASTORE_FILE) and os.path.getsize(DATASTORE_FILE) > 0:
+        statuses = get_file_contents(DATASTORE_FILE)
+    if not statuses:
+        statuses = create_dummy_statuses()
+    # Files from before last_success/latency were added
+    statuses.setdefault('last_success', {})
+    statuses.setdefault('latency', {})
+
+    with status_lock:
+        current_statuses = statuses
+        status_body = make_status_body(statuses)
+        persisted_values = make_status_values(statuses)
+        status_etag = make_etag(status_body)
+        status_last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def get_current_statuses():
+    ''' Returns: copy of the in-memory statuses (to update and pass to set_statuses) '''
+    with status_lock:
+        return json.loads(json.dumps(current_statuses))
+
+
+def set_statuses(statuses):
+    '''
+        Replaces the in-memory statuses
+            If anything changed (latency and last_success included), the ETag and Last-Modified move on
+            The statuses file is only written when a service's status changed (the volatile fields are saved along with it)
+
+        Returns:
+            True (the statuses changed), False (nothing changed)
+    '''
+    global current_statuses, status_body, persisted_values, status_etag, status_last_modified
+
+    body = make_status_body(statuses)
+    values = make_status_values(statuses)
+    with status_lock:
+        if body == status_body:
+            return False
+
+        current_statuses = statuses
+        status_body = body
+        status_etag = make_etag(body)
+        status_last_modified = datetime.now(timezone.utc).replace(microsecond=0) # HTTP dates only have whole seconds
+        if values != persisted_values:
+            # Written while holding the lock so an older version can't be renamed over a newer one
+            write_to_file(DATASTORE_FILE, statuses)
+            persisted_values = values
+    return True
+
+
+def is_not_modified(etag, last_modified):
+    ''' Checks the conditional GET headers - If-None-Match is used over If-Modified-Since when both are sent '''
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak validators (W/"...") compare the same as strong ones for GET
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError): # Invalid date, or one without a timezone
+            return False
+    return False
+
+
 # GET Endpoint function for checking health of backend services
-    # Reads statuses from statuses file and returns it
+    # Returns the in-memory statuses
     # Called through /health endpoint
+    # Sends ETag/Last-Modified, and 304 with no body if the client already has the current statuses
 def get_statuses():
     ''' 
-        Checks health of backend services from the statuses file
+        Checks health of backend services
         
         Returns: 
             dict: Status of each service and the time of the last update
     '''
     logger.info("GET request to '/statuses' was received.")
-    # If file doesn't exist, return nothing with status code 404
-    if not os.path.isfile(DATASTORE_FILE):
-        logger.error(f"Statuses do not exist. File: '{DATASTORE_FILE}' could not be found.")
-        return NoContent, 404
-    # If file exists, return dict version of statuses with status code 200
-    else:
-        # Read from file
-        statuses = get_file_contents(DATASTORE_FILE)
-        logger.debug(f"Statuses file contents:\n{statuses}")
-        logger.info("GET request to '/statuses' was received.")
-        return statuses, 200
+
+    # Heartbeats are checked when asked, so a service is shown as down as soon as its heartbeats expire
+        # last_success moves with every heartbeat (and with it the ETag), but the file is only written when a service goes up or down
+    if MONITOR_MODE == 'heartbeat':
+        statuses = get_current_statuses()
+        update_statuses_from_heartbeats(statuses)
+        set_statuses(statuses)
+
+    with status_lock:
+        statuses = current_statuses # Replaced (never changed) by set_statuses, so safe to return
+        etag = status_etag
+        last_modified = status_last_modified
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache" # Browsers check with the ETag each time instead of guessing how long to cache for
+    }
+    if is_not_modified(etag, last_modified):
+        return NoContent, 304, headers
+
+    logger.debug(f"Statuses:\n{statuses}")
+    return statuses, 200, headers
+
+
+# Heartbeats (heartbeat monitor mode)
+heartbeat_registry = HeartbeatRegistry(HEARTBEAT_TTL, HEARTBEAT_FORGET_AFTER)
+
+
+# POST Endpoint function for receiving heartbeats from backend services
+    # Called through /heartbeat endpoint
+def post_heartbeat(body):
+    ''' 
+        Records a heartbeat from an instance of a backend service
+
+        Returns:
+            204 (recorded), 400 (unknown service)
+    '''
+    if body['service'] not in SERVICES:
+        return { "message": f"Unknown service: {body['service']}" }, 400
+    heartbeat_registry.beat(body['service'], body['instance'], body.get('counters', {}))
+    return NoContent, 204
+
+
+def update_statuses_from_heartbeats(statuses):
+    ''' Sets each service's status from its heartbeats - Running while any instance's last heartbeat is within the TTL '''
+    for service_name in SERVICES:
+        alive, _ = heartbeat_registry.get_instances(service_name)
+        statuses[service_name] = "Running" if alive else "Down"
+        if alive:
+            statuses['last_success'][service_name] = alive[0]['received_at']
+
+
+# Probing (poll monitor mode) and dashboard snapshots
+    # Requests run on one event loop in a background thread, sharing a single async client (and its connections) between runs
+probe_loop = asyncio.new_event_loop()
+# Set 5 second time limit for waiting for response body to be received
+# If response isn't received, raise ReadTimeout exception (set 10 second timeout by default)
+probe_client = httpx.AsyncClient(timeout=httpx.Timeout(DEFAULT_TIMEOUT_INTERVAL, read=READ_TIMEOUT_INTERVAL))
+latency_histograms = { service_name: LatencyHistogram(LATENCY_WINDOW) for service_name in SERVICES }
+
+
+def run_probe_loop():
+    asyncio.set_event_loop(probe_loop)
+    probe_loop.run_forever()
+
+
+def setup_probe_thread():
+    t1 = Thread(target=run_probe_loop)
+    t1.daemon = True
+    t1.start()
+
+
+async def probe_service(service_name, url):
+    '''
+        Sends a GET request to a service's /health endpoint
+
+        Returns:
+            (status string, latency in ms or None if no response was received)
+    '''
+    start = time.monotonic()
+    try:
+        response = await probe_client.get(url)
+    except Exception as e:
+        logger.error(f"Error: Did not receive response body from '{url}'. Exception {e!r}")
+        return "Down", None
+    latency_ms = (time.monotonic() - start) * 1000
+
+    if response.status_code == 200: # Status code will be 200 if service is running
+        try:
+            return response.json()['status'], latency_ms # Status based on response body ("Running" if running)
+        except (ValueError, KeyError) as e: # Body isn't JSON, or has no status
+            logger.error(f"Error: Invalid response body from '{url}'. Exception {e!r}")
+            return "Down", latency_ms
+    logger.error(f"GET request to '{url}' failed with status code {response.status_code}")
+    return "Down", latency_ms
+
+
+async def probe_services():
+    ''' Returns: dict of service name -> (status, latency in ms or None), probed at the same time '''
+    results = await asyncio.gather(*[
+        probe_service(service_name, service_info['url']) for service_name, service_info in SERVICES.items()
+    ])
+    return dict(zip(SERVICES, results))
 
 
 # Updates statuses in the statuses file
@@ -115,61 +346,125 @@ def get_statuses():
     # Constantly running in background
 def populate_statuses():
     ''' 
-        Updates health statuses in the statuses file based on GET requests to each service's /health endpoint
+        Updates the health statuses based on GET requests to each service's /health endpoint
+            All services are probed at the same time, so a round takes as long as the slowest probe
     '''
     logger.info("Periodic health checking has started.")
+    round_start = time.monotonic()
 
-    timeout = httpx.Timeout(DEFAULT_TIMEOUT_INTERVAL, read=READ_TIMEOUT_INTERVAL) # Set 5 second time limit for waiting for response body to be received
-    # If response isn't received, raise ReadTimeout exception (set 10 second timeout by default)
-    client = httpx.Client(timeout=timeout)
-
-    # Check if file statuses.json exists, create file if it doesn't
-    if does_file_exist(DATASTORE_FILE):
-        # If file is empty, populate with dummy statuses
-        if os.path.getsize(DATASTORE_FILE) == 0:
-            dummy_statuses = create_dummy_statuses()
-            write_to_file(DATASTORE_FILE, dummy_statuses)
-
-    # Update statuses received from the statuses.json file and then overwrite the statuses.json file at the end
-    statuses = get_file_contents(DATASTORE_FILE)
+    # Update a copy of the in-memory statuses
+    statuses = get_current_statuses()
 
-    # Compare current time with last updated time for triggering the scheduler
-    last_updated_time = statuses['last_update']
     # Get current time (in UTC since that's what the MySQL database is storing the other timestamps as)
     current_datetime = datetime.now(timezone.utc)
     # Convert it to string in the format Year-Month-Day Hours-Minutes-Seconds
     current_datetime_str = datetime.strftime(current_datetime, "%Y-%m-%d %H:%M:%S")
 
+    # Services push heartbeats, so nothing needs to be requested
+    if MONITOR_MODE == 'heartbeat':
+        update_statuses_from_heartbeats(statuses)
+        results = {}
     # Handling service health GET endpoints and statuses
-        # Retrieving service name and the dictionary of variables nested under it (just URL for now)
-    for service_name, service_info in SERVICES.items():
-        try:
-            response = client.get(service_info['url'])
-            if response.status_code == 200: # Status code will be 200 if service is running
-                response_data = response.json()
-                service_health = response_data['status'] # Get status based on response body ("Running" if running)
-                statuses[service_name] = service_health
-                logger.info(f"Status of {service_name} is: {service_health}")
-            else:
-                logger.error(f"GET request to '{service_info['url']}' failed with status code {response.status_code}")
-                service_health = "Down"
-                statuses[service_name] = service_health
-                logger.info(f"Status of {service_name} is: {service_health}")
-        except Exception as e:
-            logger.error(f"Error: Did not receive response body from '{service_info['url']}'. Exception {e}")
-            service_health = "Down"
-            statuses[service_name] = service_health
-
-    # Update last updated time even if no readings were received
+    else:
+        results = asyncio.run_coroutine_threadsafe(probe_services(), probe_loop).result()
+    for service_name, (service_health, latency_ms) in results.items():
+        statuses[service_name] = service_health
+        logger.info(f"Status of {service_name} is: {service_health}")
+        # Slow services still respond (latency goes up) while down services don't (last_success stops moving)
+        if latency_ms is not None:
+            latency_histograms[service_name].add(latency_ms)
+        if service_health == "Running":
+            statuses['last_success'][service_name] = current_datetime_str
+        statuses['latency'][service_name] = latency_histograms[service_name].to_dict()
+
+    # Update last updated time even if no status changed
     statuses['last_update'] = current_datetime_str
 
-    # Overwrite content in file
-    write_to_file(DATASTORE_FILE, statuses)
+    # Saved to file only if a service's status changed
+    if set_statuses(statuses):
+        logger.debug(f"New statuses:\n{statuses}")
+
+    logger.info(f"Periodic health checking has ended ({(time.monotonic() - round_start) * 1000:.0f} ms).")
+
+
+# Dashboard
+    # One snapshot of everything the dashboard shows, built from a few requests at most once per DASHBOARD_TTL
+    # so the load on the other services doesn't grow with the number of people watching
+async def fetch_json(url, missing_ok=False):
+    '''
+        missing_ok: a 404 means there's nothing to show yet, not an error
+        Returns:
+            (response JSON or None, error message or None)
+    '''
+    try:
+        response = await probe_client.get(url, timeout=DASHBOARD_TIMEOUT)
+    except Exception as e:
+        return None, f"GET request to '{url}' failed: {e!r}"
+    if missing_ok and response.status_code == 404:
+        return None, None
+    if response.status_code != 200:
+        return None, f"GET request to '{url}' failed with status code {response.status_code}"
+    return response.json(), None
+
+
+async def compose_dashboard(previous):
+    '''
+        previous: the last snapshot (None the first time)
+        Returns: dict with the statuses, processing and analyzer stats, and a random volume and type event
+    '''
+    results = await asyncio.gather(
+        fetch_json(DASHBOARD_PROCESSING_STATS_URL),
+        fetch_json(DASHBOARD_ANALYZER_URLS['stats_url'])
+    )
+    (processing_stats, _), (analyzer_stats, _) = results
+    errors = [error for _, error in results if error is not None]
+
+    # The random events are kept until the analyzer receives new readings, so the snapshot (and its ETag) stays the same while nothing happens
+    if previous is not None and analyzer_stats is not None and analyzer_stats == previous['analyzer_stats']:
+        volume_event, type_event = previous['volume_event'], previous['type_event']
+    else:
+        # From the analyzer's in-memory samples (404 until it has received a reading of that type)
+        sample_results = await asyncio.gather(
+            fetch_json(DASHBOARD_ANALYZER_URLS['volume_sample_url'], missing_ok=True),
+            fetch_json(DASHBOARD_ANALYZER_URLS['type_sample_url'], missing_ok=True)
+        )
+        (volume_event, _), (type_event, _) = sample_results
+        errors += [error for _, error in sample_results if error is not None]
+
+    with status_lock:
+        statuses = current_statuses
+
+    return {
+        'statuses': statuses,
+        'processing_stats': processing_stats,
+        'analyzer_stats': analyzer_stats,
+        'volume_event': volume_event,
+        'type_event': type_event,
+        'errors': errors
+    }
+
+
+dashboard_cache = DashboardCache(
+    DASHBOARD_TTL,
+    lambda previous: asyncio.run_coroutine_threadsafe(compose_dashboard(previous), probe_loop).result()
+)
 
-    logger.debug(f"New statuses:\n{statuses}")
 
-    logger.info("Periodic health checking has ended.")
+# GET Endpoint function for the dashboard
+    # Called through /dashboard endpoint
+    # Sends an ETag, and 304 with no body if the browser already has the current snapshot (If-None-Match)
+def get_dashboard():
+    logger.info("GET request to '/dashboard' was received.")
+    snapshot, etag = dashboard_cache.get()
 
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache" # Browsers check with the ETag each time
+    }
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return NoContent, 304, headers
+    return snapshot, 200, headers
 
 
 def init_scheduler():
@@ -194,5 +489,7 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    load_statuses()
+    setup_probe_thread() # Also used for dashboard snapshots in heartbeat mode
     init_scheduler()
     app.run(port=8120, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,30 @@
+import time # For snapshot expiry
+import json
+import hashlib # For snapshot ETags
+from threading import Lock
+
+
+# Dashboard snapshot shared by every viewer
+    # The snapshot is rebuilt at most once per `ttl` seconds, no matter how many browsers are asking
+    # Only one thread rebuilds it - the others wait for that snapshot instead of building their own
+class DashboardCache:
+    def __init__(self, ttl, compose):
+        self.ttl = ttl
+        self.compose = compose # Builds a new snapshot (dict) from the previous one (None the first time)
+        self.lock = Lock()
+        self.snapshot = None
+        self.etag = None # Quoted hash of the snapshot - only changes when its content does
+        self.updated = None # time.monotonic() of the last rebuild
+
+
+    def get(self):
+        """Returns: (snapshot, etag)"""
+        with self.lock:
+            if self.snapshot is None or time.monotonic() - self.updated >= self.ttl:
+                snapshot = self.compose(self.snapshot)
+                if snapshot != self.snapshot:
+                    body = json.dumps(snapshot, separators=(',', ':'), sort_keys=True)
+                    self.etag = f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"'
+                self.snapshot = snapshot
+                self.updated = time.monotonic()
+            return self.snapshot, self.etag
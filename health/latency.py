@@ -0,0 +1,46 @@
+import bisect # For finding a latency's bucket
+from collections import deque
+
+
+# Histogram of the most recent probe latencies for one service
+    # Only the last `window` probes are kept, and the oldest one is taken out of its bucket as a new one comes in
+class LatencyHistogram:
+    BOUNDS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000] # Bucket upper bounds (the last bucket is everything above)
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window) # Milliseconds, oldest first
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+
+
+    def add(self, latency_ms):
+        if len(self.latencies) == self.latencies.maxlen:
+            self.counts[self.bucket(self.latencies[0])] -= 1 # Dropped from the window by the append below
+        self.latencies.append(latency_ms)
+        self.counts[self.bucket(latency_ms)] += 1
+
+
+    def bucket(self, latency_ms):
+        return bisect.bisect_left(self.BOUNDS_MS, latency_ms)
+
+
+    def percentile(self, percentile):
+        """Returns: latency (ms) at the percentile of the window, None if there are no probes yet"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile / 100 * len(ordered)))]
+
+
+    def to_dict(self):
+        return {
+            'num_probes': len(self.latencies),
+            'last_ms': self.latencies[-1] if self.latencies else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'max_ms': max(self.latencies) if self.latencies else None,
+            # le_ms of None is the bucket for everything above the largest bound
+            'buckets': [
+                { 'le_ms': bound, 'count': count }
+                for bound, count in zip(self.BOUNDS_MS + [None], self.counts)
+            ]
+        }
@@ -1,5 +1,6 @@
 import connexion
 from connexion import NoContent
+from connexion import request # For reading the If-None-Match header
 
 # Disabling CORS
 from connexion.middleware import MiddlewarePosition
@@ -7,25 +8,68 @@ from starlette.middleware.cors import CORSMiddleware
 
 import os.path # For reading and writing to files
 import json # For data operations
-from datetime import datetime, timezone # For creating and formatting timestamps and converting timezones 
+from datetime import datetime, timedelta, timezone # For creating and formatting timestamps and converting timezones 
+import time # For kafka sleep
+import random
+import hashlib # For stats ETags
 
 import yaml # For using the yaml config file (app_conf)
 import httpx # For sending get requests to storage service (for calculating stats)
+import numpy as np # For aggregating batches of readings
+from concurrent.futures import ThreadPoolExecutor # For fetching volume and type readings at the same time
 
 # For creating and displaying log messages (log_conf)
 import logging
 import logging.config
 
+# Constant-memory distribution statistics (mean, stddev, percentiles)
+from sketches import DistributionStats, SalonStats
+# Per-minute/per-hour stats history
+from history import StatsHistory
+
 # Scheduling
 from apscheduler.schedulers.background import BackgroundScheduler 
 
+# For message brokering (kafka stats mode)
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+
+# Threading
+from threading import Thread, Lock
+
+# Heartbeats to the monitors (shared with the other services)
+from common.heartbeat import setup_heartbeat_thread
+
 # Setting app configurations
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
 DATASTORE_FILE = app_config['datastore']['filename']
+BACKFILL_FILE = f"{DATASTORE_FILE}.backfill" # Stats recomputed by backfill.py, waiting to be installed
 VOLUME_URL = app_config['eventstores']['volume']['url']
 TYPE_URL = app_config['eventstores']['type']['url']
+PAGE_SIZE = app_config['eventstores']['page_size'] # Readings per request when pulling from storage
+SETTLE_SECONDS = app_config['eventstores']['settle_seconds'] # Readings newer than this are left for a later run
+FETCH_TIMEOUT = app_config['eventstores']['timeout'] # Seconds to wait for storage per request
+FETCH_RETRIES = app_config['eventstores']['retries'] # Attempts per request before the run is abandoned
+FETCH_BACKOFF = app_config['eventstores']['backoff'] # Seconds before the first retry (doubles after each one)
+FETCH_MAX_CONNECTIONS = app_config['eventstores']['max_connections'] # Connections kept open to storage
+SCHEDULER_INTERVAL = app_config['scheduler']['interval']
+SKETCH_K = app_config['sketches']['k'] # Size of the quantile sketches (bigger = more accurate percentiles)
+# Memory cap for per-salon stats
+SALONS_CAPACITY = app_config['salons']['capacity'] # Max salons tracked exactly for top producers
+SALONS_CMS_WIDTH = app_config['salons']['cms_width'] # Count-min sketch counters per row
+SALONS_CMS_DEPTH = app_config['salons']['cms_depth'] # Count-min sketch rows
+# Size of the stats history ring buffers
+HISTORY_MINUTES = app_config['history']['minutes'] # Per-minute buckets kept
+HISTORY_HOURS = app_config['history']['hours'] # Per-hour buckets kept
+
+# 'storage' polls storage on the scheduler interval, 'kafka' updates stats from every event on the topic
+STATS_MODE = app_config['stats']['mode']
+
+# Heartbeats to the monitors (optional - for health/check in heartbeat monitor mode)
+HEARTBEAT_ENABLED = app_config['heartbeat']['enabled']
 
 # Setting logging configurations
 with open("config/log_conf.yaml", "r") as f:
@@ -34,6 +78,109 @@ with open("config/log_conf.yaml", "r") as f:
 
 logger = logging.getLogger('basicLogger')
 
+
+# Message brokering (kafka stats mode)
+# Create class for managing Kafka connections (client and consumer)
+class KafkaWrapper:
+    def __init__(self, hostname, topic, get_resume_offsets):
+        self.hostname = hostname
+        self.topic = topic
+        self.get_resume_offsets = get_resume_offsets # Returns {partition id: last offset consumed} to resume from
+        self.client = None
+        self.consumer = None
+        self.connect()
+
+
+    # Infinitely attempt to create a working client and consumer
+    def connect(self):
+        """Infinite loop: will keep trying"""
+
+        while True: # Try until successful
+            logger.debug("Trying to connect to Kafka...")
+            if self.make_client(): # Tries to make a Kafka client
+                if self.make_consumer(): # Tries to make a Kafka consumer
+                    # If client and consumer successfully created/already existing, stop trying to create them
+                    break
+            # Sleeps for a random amount of time (0.5 to 1.5s)
+            time.sleep(random.randint(500, 1500) / 1000)
+
+
+    def make_client(self):
+        """
+        Runs once, makes a client and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+
+        if self.client is not None: # if client already exists, don't make one
+            return True
+
+        try:
+            # Make client and save it in self.client
+            self.client = KafkaClient(hosts=self.hostname)
+            logger.info("Kafka client created!")
+            return True
+        except KafkaException as e:
+            msg = f"Kafka error when making client: {e}"
+            logger.warning(msg)
+            self.client = None
+            self.consumer = None
+            return False
+
+
+    def make_consumer(self):
+        """
+        Runs once, makes a consumer that resumes from the checkpointed offsets and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+
+        if self.consumer is not None:
+            return True # if consumer already exists, don't make one
+        if self.client is None:
+            return False # Don't try to create consumer if client doesn't exist
+
+        try:
+            topic = self.client.topics[self.topic]
+            self.consumer = topic.get_simple_consumer(
+                reset_offset_on_start=True, # Partitions without a checkpoint start from the beginning...
+                auto_offset_reset=OffsetType.EARLIEST # ...so every event is counted once
+            )
+            # Continue after the last event counted in the checkpointed stats
+            resume_offsets = [
+                (topic.partitions[partition_id], offset)
+                for partition_id, offset in self.get_resume_offsets().items()
+                if partition_id in topic.partitions
+            ]
+            if resume_offsets:
+                self.consumer.reset_offsets(resume_offsets)
+            return True
+        except KafkaException as e: # Will be triggered if Kafka is down
+            msg = f"Make error when making consumer: {e}"
+            logger.warning(msg)
+            self.client = None
+            self.consumer = None
+            return False # connect() will retry
+
+
+    def messages(self):
+        """Generator method that catches exceptions in the consumer loop"""
+
+        if self.consumer is None:
+            self.connect() # Try to create/reconnect client and consumer
+
+        while True: # Runs infinitely
+            try:
+                for msg in self.consumer:
+                    yield msg # To be used in process_messages()
+            # If any error occurs, keep trying
+            except KafkaException as e:
+                # Reset client and consumer and attempt to reconnect
+                msg = f"Kafka issue in comsumer: {e}"
+                logger.warning(msg)
+                self.client = None
+                self.consumer = None
+                self.connect()
+
+
 # File helper functions
 def does_file_exist(filename):
     if os.path.isfile(filename):
@@ -53,8 +200,11 @@ def get_file_contents(filename):
     return content
 
 def write_to_file(filename, content):
-    with open(filename, 'w') as my_file: # 'w' to write - will overwrite file if there's anything there already
-        my_file.write(json.dumps(content, indent=4)) # Convert python dict into json (indent for formatting)
+    # Written to a temp file and renamed over the old one, so readers never see a half-written file
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w') as my_file:
+        my_file.write(json.dumps(content, separators=(',', ':'))) # Compact - the file is only read by this service
+    os.replace(temp_filename, filename) # Atomic on the same filesystem
 
 
 # Generating statistics from readings
@@ -77,122 +227,518 @@ def create_dummy_stats():
     return dummy_stats
 
 
+# In-memory stats
+    # Updated by populate_stats() (storage mode) or the consumer thread (kafka mode) and served straight from memory
+    # The datastore file is only read at startup and written when the values change
+stats_lock = Lock()
+live_stats = None # Set by load_live_stats()
+live_distributions = None # Sketches for the distribution stats (saved in live_stats when the stats are updated)
+last_persisted = None # Compact JSON of the values last written to the datastore file
+
+
+def load_live_stats():
+    ''' Loads the last saved stats, per-salon stats and stats history from the datastore file (or dummy stats) into memory '''
+    global live_stats, live_distributions
+
+    stats = {}
+    if does_file_exist(DATASTORE_FILE) and os.path.getsize(DATASTORE_FILE) > 0:
+        stats = get_file_contents(DATASTORE_FILE)
+    if not stats:
+        stats = create_dummy_stats()
+    # Stats without offsets weren't made from the topic (e.g. storage mode), so recount everything from the beginning
+        # The per-salon stats and history start over too, or the recount would add the same readings to them twice
+    if STATS_MODE == 'kafka' and 'offsets' not in stats:
+        stats = create_dummy_stats()
+        stats['offsets'] = {} # Partition id (str) -> last offset counted
+
+    load_in_memory_stats(stats)
+    with stats_lock:
+        live_stats = stats
+        live_distributions = load_distributions(stats)
+
+
+def persist_stats(stats):
+    '''
+        Writes the stats to the datastore file if any values changed since the last write
+
+        Returns:
+            True (written), False (unchanged)
+    '''
+    global last_persisted
+
+    values = json.dumps(stats, separators=(',', ':'), sort_keys=True)
+    if values == last_persisted:
+        return False
+
+    write_to_file(DATASTORE_FILE, stats)
+    last_persisted = values
+    return True
+
+
+def make_etag(content):
+    ''' Returns: quoted hash of the compact JSON of the content '''
+    body = json.dumps(content, separators=(',', ':'), sort_keys=True)
+    return f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    ''' Checks an If-None-Match header (one or more ETags, or *) against the current ETag '''
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # Weak validators (W/"...") compare the same as strong ones for GET
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
 # API endpoint function
-# Reads stats from file and returns it
+# Returns the in-memory stats
     # Called through the stats endpoint 
+    # Sends an ETag, and 304 with no body if the client already has the current stats (If-None-Match)
+    # date_last_updated only moves when readings are counted, so the ETag stays the same while nothing changes
 def get_stats():
     logger.info("GET request to '/stats' was received.")
-    # If file doesn't exist, return nothing with status code 404
-    if not os.path.isfile(DATASTORE_FILE):
-        logger.error(f"Statisics do not exist. File: '{DATASTORE_FILE}' could not be found.")
+    if live_stats is None:
+        logger.error("Statistics have not been loaded yet.")
         return NoContent, 404
-    # If file exists, return dict version of stats with status code 200
-    else:
-        # Read from file
-        stats = get_file_contents(DATASTORE_FILE)
-        logger.debug(f"stats file contents:\n{stats}")
-        logger.info("GET request to '/stats' was received.")
-        return stats, 200
 
+    with stats_lock:
+        # In kafka stats mode, the distribution stats are only updated when needed
+        if STATS_MODE == 'kafka':
+            save_distributions(live_stats, live_distributions)
+        stats = make_stats_response(live_stats)
+
+    etag = make_etag(stats)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return NoContent, 304, {"ETag": etag}
+
+    logger.debug(f"stats contents:\n{stats}")
+    return stats, 200, {"ETag": etag}
+
+
+# Distribution statistics helpers
+    # Sketches are saved in the datastore file under 'distributions' so they keep accumulating across runs
+DISTRIBUTION_NAMES = ['vol_grams', 'type_thickness']
+
+
+def load_distributions(stats):
+    ''' Returns: dict of DistributionStats (from the stats, or empty if they don't have any yet) '''
+    saved = stats.get('distributions', {})
+    return {
+        name: DistributionStats.from_dict(saved[name]) if name in saved else DistributionStats(SKETCH_K)
+        for name in DISTRIBUTION_NAMES
+    }
+
+
+def save_distributions(stats, distributions):
+    ''' Saves the sketches in the stats and updates the mean/stddev/percentile stats from them '''
+    stats['distributions'] = {}
+    for name, distribution in distributions.items():
+        stats.update(distribution.summary(name))
+        stats['distributions'][name] = distribution.to_dict()
 
-# Updates stats in a file
-    # Makes GET requests to storage
-    # Constantly running in background
-def populate_stats():
-    logger.info("Periodic processing has started.")
 
-    # Check if file data.json exists, create file if it doesn't
-    if does_file_exist(DATASTORE_FILE):
-        # If file is empty, populate with dummy stats
-        if os.path.getsize(DATASTORE_FILE) == 0:
-            dummy_stats = create_dummy_stats()
-            write_to_file(DATASTORE_FILE, dummy_stats)
+def make_stats_response(stats):
+    ''' The sketches are only needed for updating the stats, so they're left out of the /stats response '''
+    return { key: value for key, value in stats.items() if key not in ['distributions', 'salons', 'history'] }
 
-    # Update stats received from the data.json file and then overwrite the data.json file at the end
-    stats = get_file_contents(DATASTORE_FILE)
 
-    # Variables for logging messages
-    num_vol_readings_from_query = 0
-    num_type_readings_from_query = 0
+# Per-salon stats and stats history
+    # Held in memory so their endpoints don't read the datastore file, saved under 'salons' and 'history' whenever the stats are written
+salon_lock = Lock()
+salon_stats = None # Set by load_in_memory_stats()
+history_lock = Lock()
+stats_history = None # Set by load_in_memory_stats()
 
-    # Variables for reading-specific statistics
-    vol_grams_min = stats['min_vol_grams']
-    vol_grams_max = stats['max_vol_grams']
-    type_thickness_max = stats['max_type_thickness']
+
+def load_in_memory_stats(stats):
+    ''' Loads the per-salon stats and stats history from the saved stats (or starts empty) - see load_live_stats() '''
+    global salon_stats, stats_history
+
+    with salon_lock:
+        if 'salons' in stats:
+            salon_stats = SalonStats.from_dict(stats['salons'])
+        else:
+            salon_stats = SalonStats(SALONS_CAPACITY, SALONS_CMS_WIDTH, SALONS_CMS_DEPTH)
+
+    with history_lock:
+        if 'history' in stats:
+            stats_history = StatsHistory.from_dict(stats['history'])
+        else:
+            stats_history = StatsHistory(HISTORY_MINUTES, HISTORY_HOURS)
+
+
+def save_in_memory_stats(stats):
+    with salon_lock:
+        stats['salons'] = salon_stats.to_dict()
+    with history_lock:
+        stats['history'] = stats_history.to_dict()
+
+
+# API endpoint function
+    # Called through the /stats/salons endpoint
+def get_salon_stats(top=10, salon_id=None):
+    ''' 
+        Gets the salons with the highest hair volume totals, or the total for one salon
+
+        Returns:
+            dict: top salons (or one salon's total)
+    '''
+    logger.info("GET request to '/stats/salons' was received.")
+    if salon_stats is None:
+        return NoContent, 404
+
+    with salon_lock:
+        if salon_id is not None:
+            return salon_stats.get(salon_id), 200
+        return { "top_salons": salon_stats.top(top) }, 200
+
+
+# API endpoint function
+    # Called through the /stats/history endpoint
+def get_stats_history(from_=None, to=None, resolution="minute"):
+    ''' 
+        Gets per-minute or per-hour reading counts and min/max values between two timestamps
+            Defaults to everything the resolution holds, up to now
+
+        Returns:
+            dict: list of buckets
+    '''
+    logger.info("GET request to '/stats/history' was received.")
+    if stats_history is None:
+        return NoContent, 404
+
+    try:
+        end = parse_utc_timestamp(to) if to is not None else time.time()
+        start = parse_utc_timestamp(from_) if from_ is not None else end - stats_history.span(resolution)
+    except ValueError:
+        return { "message": "from and to must be in the format YYYY-MM-DD HH:MM:SS" }, 400
+
+    with history_lock:
+        buckets = stats_history.query(start, end, resolution)
+
+    return { "resolution": resolution, "buckets": buckets }, 200
+
+
+def parse_utc_timestamp(timestamp):
+    ''' Returns: epoch seconds for a "%Y-%m-%d %H:%M:%S" UTC timestamp '''
+    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+
+# HTTP client for storage
+    # Made once and shared so connections are reused between runs (httpx clients are thread-safe)
+http_client = httpx.Client(
+    timeout=httpx.Timeout(FETCH_TIMEOUT),
+    limits=httpx.Limits(max_connections=FETCH_MAX_CONNECTIONS, max_keepalive_connections=FETCH_MAX_CONNECTIONS)
+)
+# One worker per reading type
+fetch_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def get_with_retries(url, query_params, client=http_client):
+    '''
+        GET request to storage, retried with backoff on connection errors, timeouts and 5xx responses
+            client: httpx.Client to send it with (backfill.py workers have their own)
+
+        Returns:
+            httpx.Response: successful response
+        Raises:
+            httpx.HTTPError: all attempts failed (or a 4xx response, which won't change by retrying)
+    '''
+    for attempt in range(1, FETCH_RETRIES + 1):
+        try:
+            response = client.get(url, params=query_params)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code < 500 or attempt == FETCH_RETRIES:
+                raise
+            logger.warning(f"GET request to '{url}' failed with status code {e.response.status_code} (attempt {attempt} of {FETCH_RETRIES})")
+        except httpx.TransportError as e:
+            if attempt == FETCH_RETRIES:
+                raise
+            logger.warning(f"GET request to '{url}' failed: {e!r} (attempt {attempt} of {FETCH_RETRIES})")
+        time.sleep(FETCH_BACKOFF * 2 ** (attempt - 1))
+
+
+# Fields kept from each reading pulled from storage, and their array types
+VOLUME_COLUMNS = { 'hair_volume': np.float64, 'salon_id': np.str_ }
+TYPE_COLUMNS = { 'hair_thickness': np.float64 }
+
+
+def make_columns(readings, columns):
+    ''' Returns: dict of numpy arrays (one per field) from a list of reading dicts '''
+    return {
+        field: np.array([reading[field] for reading in readings], dtype=dtype)
+        for field, dtype in columns.items()
+    }
+
+
+# Query parameters for pulling new readings from storage
+    # after_id once the last id is known (fetches exactly the new rows), otherwise the timestamps
+    # Only readings created before pull_until are pulled: ids are handed out when a row is inserted, not when it's
+    # committed, so a reading with a lower id can still show up after a higher one has been pulled (concurrent storage
+    # writers). Waiting SETTLE_SECONDS before moving the watermark past a reading keeps those from being skipped.
+def make_query_params(last_id, last_updated_time, pull_until):
+    if last_id is not None:
+        return {'after_id': last_id, 'end_timestamp': pull_until, 'limit': PAGE_SIZE}
+    return {'start_timestamp': last_updated_time, 'end_timestamp': pull_until, 'limit': PAGE_SIZE}
+
+
+def fetch_new_readings(url, columns, last_id, last_updated_time, pull_until):
+    '''
+        Gets the readings added since the last run from storage, one page at a time
+            Pulls by id page on the last id, pulls by timestamp follow X-Next-Cursor
+            Each page is turned into arrays as it arrives, so the reading dicts don't pile up in memory
+
+        Returns:
+            (dict of numpy arrays - see make_columns, last id seen or None)
+        Raises:
+            httpx.HTTPError: a request failed (see get_with_retries)
+    '''
+    pages = []
+    query_params = make_query_params(last_id, last_updated_time, pull_until)
+
+    while True:
+        response = get_with_retries(url, query_params)
+
+        page = response.json()
+        pages.append(make_columns(page, columns))
+        # Highest id seen - the next pull starts after it (timestamp pages aren't in id order)
+        if 'X-Last-Id' in response.headers:
+            page_last_id = int(response.headers['X-Last-Id'])
+            last_id = page_last_id if last_id is None else max(last_id, page_last_id)
+
+        if 'after_id' in query_params:
+            # A page smaller than the limit means there's nothing left
+            if len(page) < PAGE_SIZE:
+                break
+            query_params = {**query_params, 'after_id': last_id}
+        else:
+            if 'X-Next-Cursor' not in response.headers:
+                break
+            query_params = {**query_params, 'cursor': response.headers['X-Next-Cursor']}
+
+    return { field: np.concatenate([page[field] for page in pages]) for field in columns }, last_id
+
+
+# Updates the in-memory stats and saves them to a file if they changed
+    # Makes GET requests to storage
+    # Constantly running in background
+def populate_stats():
+    logger.info("Periodic processing has started.")
+    start = time.monotonic()
+    try:
+        update_stats_from_storage()
+    finally:
+        # Runs are skipped (not overlapped) while one is still going, so report slow runs
+        duration = time.monotonic() - start
+        if duration > SCHEDULER_INTERVAL:
+            logger.warning(f"Periodic processing took {duration:.2f}s, longer than the {SCHEDULER_INTERVAL}s interval.")
+        logger.info(f"Periodic processing has ended ({duration * 1000:.0f} ms).")
+
+
+def install_backfill():
+    '''
+        Swaps in the stats recomputed by backfill.py, if there are any waiting
+            Pulls continue from the backfill's last ids, so readings added while it ran are counted once
+            The stats history is kept, since it's bucketed by when this service pulled the readings
+    '''
+    global live_stats, live_distributions, salon_stats
+
+    if not os.path.isfile(BACKFILL_FILE):
+        return
+
+    stats = get_file_contents(BACKFILL_FILE)
+    with salon_lock:
+        salon_stats = SalonStats.from_dict(stats.pop('salons'))
+    with stats_lock:
+        live_distributions = load_distributions(stats)
+        live_stats = stats
+
+    # Save to the datastore file before removing the backfill, so it isn't lost if the service stops in between
+    file_stats = dict(stats)
+    save_in_memory_stats(file_stats)
+    persist_stats(file_stats)
+    os.remove(BACKFILL_FILE)
+    logger.info(f"Installed backfilled statistics from '{BACKFILL_FILE}'.")
+
+
+def update_stats_from_storage():
+    ''' Pulls the new readings from storage and updates the in-memory stats (nothing is updated if a pull fails) '''
+    global live_stats
+
+    install_backfill()
+
+    # Update a copy of the in-memory stats, so /stats keeps serving the last complete stats while pulling
+        # populate_stats() is the only thing that updates the stats in storage mode
+    with stats_lock:
+        stats = dict(live_stats)
 
         # Compare current time with last updated time for triggering the scheduler
     last_updated_time = stats['date_last_updated']
     # Get current time (in UTC since that's what the MySQL database is storing the other timestamps as)
     current_datetime = datetime.now(timezone.utc)
-    # Convert it to string in the format Year-Month-Day Hours-Minutes-Seconds
-    current_datetime_str = datetime.strftime(current_datetime, "%Y-%m-%d %H:%M:%S")
-
-        # Use httpx get for querying timestamps (last updated time, current time)
-        # gets list of readings from any readings found within that timeframe and updates stats
-    
-    # Handling hair volume GET endpoint and stats
-    hair_vol_query_params = {'start_timestamp': last_updated_time, 'end_timestamp': current_datetime_str}
-    hair_vol_response = httpx.get(VOLUME_URL, params=hair_vol_query_params)
-    hair_vol_response_data = hair_vol_response.json()
-    if hair_vol_response.status_code != 200:
-        logger.error(f"GET request to '{VOLUME_URL}' failed with status code {hair_vol_response.status_code}")
-    # print("hair volume query result:\n", hair_vol_response_data)
-
-    # data = list, reading = python dict
-    for reading in hair_vol_response_data:
-        num_vol_readings_from_query += 1
-        stats['num_vol_readings'] = stats['num_vol_readings'] + 1
-        # If the min_vol_grams stat is 0, then set it to the first hair volume reading...
-        # and compare it with values from following readings since the min value of a hair vlume reading would be 1...
-        # therefore, the min_vol_grams stat would never change
-        if stats['min_vol_grams'] == 0:
-            stats['min_vol_grams'] = reading['hair_volume']
-        # If value from reading is more/less than the max/min currently recorded, update relevant stat to that reading
-        if reading['hair_volume'] < vol_grams_min:
-            stats['min_vol_grams'] = reading['hair_volume']
-            vol_grams_min = reading['hair_volume']
-        if reading['hair_volume'] > vol_grams_max:
-            stats['max_vol_grams'] = reading['hair_volume']
-            vol_grams_max = reading['hair_volume']
-    
-    logger.info(f"Received {num_vol_readings_from_query} volume readings")
-
-
-    # Handling hair type GET endpoint and stats
-    hair_type_query_params = {'start_timestamp': last_updated_time, 'end_timestamp': current_datetime_str}
-    hair_type_response = httpx.get(TYPE_URL, params=hair_type_query_params)
-    hair_type_response_data = hair_type_response.json()
-    if hair_type_response.status_code != 200:
-        logger.error(f"GET request to '{TYPE_URL}' failed with status code {hair_type_response.status_code}")
-    # print("hair type query result:\n", hair_type_response_data)
-
-    # data = list, reading = python dict
-    for reading in hair_type_response_data:
-        num_type_readings_from_query += 1
-        stats['num_type_readings'] = stats['num_type_readings'] + 1
-        if reading['hair_thickness'] > type_thickness_max:
-            stats['max_type_thickness'] = reading['hair_thickness']      
-            type_thickness_max = reading['hair_thickness']
-    
-    logger.info(f"Received {num_type_readings_from_query} type readings")
-
-    # Update last updated time even if no readings were received
-    stats['date_last_updated'] = current_datetime_str
-
-    # Overwrite content in file
-    write_to_file(DATASTORE_FILE, stats)
-
-    logger.debug(f"New statistics:\n{stats}")
-
-    logger.info("Periodic processing has ended.")
+    # Readings created from here on are left for a later run (see make_query_params)
+    pull_until = datetime.strftime(current_datetime - timedelta(seconds=SETTLE_SECONDS), "%Y-%m-%d %H:%M:%S")
+
+        # Query storage for the readings added since the last run, volume and type at the same time
+        # Once a reading has been seen, pulls use the last id seen (exact watermark) instead of the timestamps
+    vol_future = fetch_executor.submit(fetch_new_readings, VOLUME_URL, VOLUME_COLUMNS, stats.get('last_vol_id'), last_updated_time, pull_until)
+    type_future = fetch_executor.submit(fetch_new_readings, TYPE_URL, TYPE_COLUMNS, stats.get('last_type_id'), last_updated_time, pull_until)
+    try:
+        vol_columns, stats['last_vol_id'] = vol_future.result()
+        type_columns, stats['last_type_id'] = type_future.result()
+    except httpx.HTTPError as e:
+        # Nothing is updated, so the next run pulls the same readings again
+        logger.error(f"Couldn't get new readings from storage, stats were not updated (last updated {last_updated_time}): {e!r}")
+        return
+
+    # Each batch is reduced with vectorized min/max/count instead of a loop over the readings
+    # Handling hair volume stats
+    volumes = vol_columns['hair_volume']
+    if len(volumes) > 0:
+        vol_grams_min = volumes.min().item()
+        vol_grams_max = volumes.max().item()
+        # min_vol_grams of 0 means no volume readings have been counted yet
+        if stats['min_vol_grams'] == 0 or vol_grams_min < stats['min_vol_grams']:
+            stats['min_vol_grams'] = vol_grams_min
+        if vol_grams_max > stats['max_vol_grams']:
+            stats['max_vol_grams'] = vol_grams_max
+        stats['num_vol_readings'] = stats['num_vol_readings'] + len(volumes)
+
+        with salon_lock:
+            salon_stats.add_many(vol_columns['salon_id'], volumes)
+        with history_lock:
+            stats_history.add_volume_summary(current_datetime.timestamp(), len(volumes), vol_grams_min, vol_grams_max)
+
+    logger.info(f"Received {len(volumes)} volume readings")
+
+
+    # Handling hair type stats
+    thicknesses = type_columns['hair_thickness']
+    if len(thicknesses) > 0:
+        type_thickness_min = thicknesses.min().item()
+        type_thickness_max = thicknesses.max().item()
+        if type_thickness_max > stats['max_type_thickness']:
+            stats['max_type_thickness'] = type_thickness_max
+        stats['num_type_readings'] = stats['num_type_readings'] + len(thicknesses)
+
+        with history_lock:
+            stats_history.add_type_summary(current_datetime.timestamp(), len(thicknesses), type_thickness_min, type_thickness_max)
+
+    logger.info(f"Received {len(thicknesses)} type readings")
+
+    # Last updated time moves when readings are counted (runs with no new readings don't change the stats or their ETag)
+        # The stats include every reading created before it, and until a reading has been seen, the next timestamp pull starts from here
+    if len(volumes) > 0 or len(thicknesses) > 0:
+        stats['date_last_updated'] = pull_until
+
+    with stats_lock:
+        # Update mean/stddev/percentiles and save the sketches
+        live_distributions['vol_grams'].add_many(volumes)
+        live_distributions['type_thickness'].add_many(thicknesses)
+        save_distributions(stats, live_distributions)
+        live_stats = stats
+
+    # Save to file only if something changed
+    file_stats = dict(stats)
+    save_in_memory_stats(file_stats)
+    if persist_stats(file_stats):
+        logger.debug(f"New statistics:\n{make_stats_response(stats)}")
+
+
+# Streaming stats (kafka stats mode)
+    # Stats are updated from every event as it's consumed and held in memory (live_stats)
+    # The offset of the last event counted is saved in the datastore file along with the stats
+def get_resume_offsets():
+    with stats_lock:
+        return { int(partition_id): offset for partition_id, offset in live_stats['offsets'].items() }
+
+
+def update_stats_from_event(stats, distributions, event):
+    ''' Updates stats with a single volume_reading or type_reading event '''
+    payload = event["payload"]
+    # When the receiver got the reading (for the stats history)
+    event_time = parse_utc_timestamp(event["datetime"])
+
+    if event["type"] == "volume_reading":
+        hair_volume = payload['hair_volume']
+        # min_vol_grams of 0 means no volume readings have been counted yet
+        if stats['num_vol_readings'] == 0 or hair_volume < stats['min_vol_grams']:
+            stats['min_vol_grams'] = hair_volume
+        if hair_volume > stats['max_vol_grams']:
+            stats['max_vol_grams'] = hair_volume
+        stats['num_vol_readings'] += 1
+        distributions['vol_grams'].add(hair_volume)
+        with salon_lock:
+            salon_stats.add(payload['salon_id'], hair_volume)
+        with history_lock:
+            stats_history.add_volume(event_time, hair_volume)
+    elif event["type"] == "type_reading":
+        if payload['hair_thickness'] > stats['max_type_thickness']:
+            stats['max_type_thickness'] = payload['hair_thickness']
+        stats['num_type_readings'] += 1
+        distributions['type_thickness'].add(payload['hair_thickness'])
+        with history_lock:
+            stats_history.add_type(event_time, payload['hair_thickness'])
+
+
+def process_messages():
+    ''' Updates the in-memory stats from every event on the topic using KafkaWrapper '''
+    kafka_wrapper = KafkaWrapper(
+        f"{app_config['events']['hostname']}:{app_config['events']['port']}", # host
+        str.encode(app_config['events']['topic']), # topic
+        get_resume_offsets
+    )
+
+    for msg in kafka_wrapper.messages():
+        event = json.loads(msg.value.decode('utf-8'))
+        partition_id = str(msg.partition_id)
+
+        with stats_lock:
+            # Skip events that were already counted before the last restart/reconnect
+            if msg.offset <= live_stats['offsets'].get(partition_id, -1):
+                continue
+            update_stats_from_event(live_stats, live_distributions, event)
+            live_stats['offsets'][partition_id] = msg.offset
+            live_stats['date_last_updated'] = datetime.strftime(datetime.now(timezone.utc), "%Y-%m-%d %H:%M:%S")
+
+
+def checkpoint_stats():
+    ''' Saves the in-memory stats and the offsets they include to the datastore file if they changed '''
+    with stats_lock:
+        save_distributions(live_stats, live_distributions)
+        stats = json.loads(json.dumps(live_stats)) # Copy so the consumer can keep updating while writing
+        # Taken with the offsets, so the saved salons and history don't include events past them (they'd be counted again on resume)
+        save_in_memory_stats(stats)
+
+    if persist_stats(stats):
+        logger.debug(f"Checkpointed statistics:\n{make_stats_response(stats)}")
+
+
+def setup_kafka_thread():
+    t1 = Thread(target=process_messages)
+    t1.setDaemon(True)
+    t1.start()
 
 
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'])
+    if STATS_MODE == 'kafka':
+        # Stats are updated by the consumer thread, the scheduler only saves checkpoints
+        sched.add_job(checkpoint_stats, 'interval', seconds=SCHEDULER_INTERVAL, max_instances=1, coalesce=True)
+    else:
+        # One run at a time - if a run is still going, missed runs are merged into one instead of piling up
+        sched.add_job(populate_stats, 'interval', seconds=SCHEDULER_INTERVAL, max_instances=1, coalesce=True)
     sched.start()
 
 
+def get_heartbeat_counters():
+    with stats_lock:
+        # Same fields as /stats
+        return { "num_vol_readings": live_stats['num_vol_readings'], "num_type_readings": live_stats['num_type_readings'] }
+
+
 # Endpoint function for checking health of this service
     # Called through /health endpoint
 def get_health():
@@ -200,7 +746,8 @@ def get_health():
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("config/hair-api-1.0.0-swagger.yaml", strict_validation=True, validate_responses=True)
+# pythonic_params so the 'from' query parameter can be passed as from_
+app.add_api("config/hair-api-1.0.0-swagger.yaml", strict_validation=True, validate_responses=True, pythonic_params=True)
 
 # Disabling CORS
 app.add_middleware(
@@ -213,5 +760,10 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    load_live_stats()
+    if STATS_MODE == 'kafka':
+        setup_kafka_thread()
     init_scheduler()
+    if HEARTBEAT_ENABLED:
+        setup_heartbeat_thread("processing", get_heartbeat_counters, app_config['heartbeat'])
     app.run(port=8100, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,178 @@
+'''
+    Recomputes the stats from the full history in storage
+        The time range is split into chunks that are pulled and reduced in parallel (one process per chunk),
+        then the partial stats are merged and written to the backfill file for the running service to install
+
+    Usage (in the processing container):
+        python3 backfill.py --start "2024-01-01 00:00:00" [--end "2025-01-01 00:00:00"] [--chunk-hours 6] [--workers 8]
+'''
+import argparse
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import httpx
+
+# Settings and helpers shared with the service
+from app import (
+    logger, STATS_MODE, BACKFILL_FILE, VOLUME_URL, TYPE_URL, PAGE_SIZE, SETTLE_SECONDS, SKETCH_K,
+    SALONS_CAPACITY, SALONS_CMS_WIDTH, SALONS_CMS_DEPTH, FETCH_TIMEOUT, FETCH_MAX_CONNECTIONS,
+    VOLUME_COLUMNS, TYPE_COLUMNS, DISTRIBUTION_NAMES,
+    make_columns, get_with_retries, save_distributions, write_to_file
+)
+from sketches import DistributionStats, SalonStats
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Each worker process makes its own client (connections can't be shared between processes)
+worker_client = None
+
+
+def init_worker():
+    global worker_client
+    worker_client = httpx.Client(
+        timeout=httpx.Timeout(FETCH_TIMEOUT),
+        limits=httpx.Limits(max_connections=FETCH_MAX_CONNECTIONS, max_keepalive_connections=FETCH_MAX_CONNECTIONS)
+    )
+
+
+# Partial stats for one chunk (min/max start at +/-inf so empty chunks merge cleanly)
+def make_partial():
+    return {
+        'num_vol_readings': 0,
+        'min_vol_grams': math.inf,
+        'max_vol_grams': -math.inf,
+        'num_type_readings': 0,
+        'max_type_thickness': -math.inf,
+        'last_vol_id': None,
+        'last_type_id': None,
+        'distributions': { name: DistributionStats(SKETCH_K) for name in DISTRIBUTION_NAMES },
+        'salons': SalonStats(SALONS_CAPACITY, SALONS_CMS_WIDTH, SALONS_CMS_DEPTH)
+    }
+
+
+def max_id(first, second):
+    return first if second is None else second if first is None else max(first, second)
+
+
+def fetch_pages(url, columns, start, end):
+    '''
+        Generator: pages of readings created within [start, end), following X-Next-Cursor
+        Yields: (dict of numpy arrays - see make_columns, highest id in the page or None)
+    '''
+    query_params = {'start_timestamp': start, 'end_timestamp': end, 'limit': PAGE_SIZE}
+    while True:
+        response = get_with_retries(url, query_params, worker_client)
+        last_id = int(response.headers['X-Last-Id']) if 'X-Last-Id' in response.headers else None
+        yield make_columns(response.json(), columns), last_id
+
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        query_params = {**query_params, 'cursor': response.headers['X-Next-Cursor']}
+
+
+def reduce_chunk(start, end):
+    ''' Runs in a worker process. Returns: partial stats for the readings created within [start, end) '''
+    partial = make_partial()
+
+    for columns, last_id in fetch_pages(VOLUME_URL, VOLUME_COLUMNS, start, end):
+        volumes = columns['hair_volume']
+        if len(volumes) > 0:
+            partial['num_vol_readings'] += len(volumes)
+            partial['min_vol_grams'] = min(partial['min_vol_grams'], volumes.min().item())
+            partial['max_vol_grams'] = max(partial['max_vol_grams'], volumes.max().item())
+            partial['distributions']['vol_grams'].add_many(volumes)
+            partial['salons'].add_many(columns['salon_id'], volumes)
+        partial['last_vol_id'] = max_id(partial['last_vol_id'], last_id)
+
+    for columns, last_id in fetch_pages(TYPE_URL, TYPE_COLUMNS, start, end):
+        thicknesses = columns['hair_thickness']
+        if len(thicknesses) > 0:
+            partial['num_type_readings'] += len(thicknesses)
+            partial['max_type_thickness'] = max(partial['max_type_thickness'], thicknesses.max().item())
+            partial['distributions']['type_thickness'].add_many(thicknesses)
+        partial['last_type_id'] = max_id(partial['last_type_id'], last_id)
+
+    return partial
+
+
+def merge_partials(total, partial):
+    ''' Adds one chunk's partial stats into the running total '''
+    total['num_vol_readings'] += partial['num_vol_readings']
+    total['min_vol_grams'] = min(total['min_vol_grams'], partial['min_vol_grams'])
+    total['max_vol_grams'] = max(total['max_vol_grams'], partial['max_vol_grams'])
+    total['num_type_readings'] += partial['num_type_readings']
+    total['max_type_thickness'] = max(total['max_type_thickness'], partial['max_type_thickness'])
+    total['last_vol_id'] = max_id(total['last_vol_id'], partial['last_vol_id'])
+    total['last_type_id'] = max_id(total['last_type_id'], partial['last_type_id'])
+    for name in DISTRIBUTION_NAMES:
+        total['distributions'][name].merge(partial['distributions'][name])
+    total['salons'].merge(partial['salons'])
+
+
+def make_stats(total, end):
+    ''' Returns: stats in the same format as the datastore file (min/max of 0 when there were no readings) '''
+    stats = {
+        'num_vol_readings': total['num_vol_readings'],
+        'min_vol_grams': total['min_vol_grams'] if total['num_vol_readings'] > 0 else 0,
+        'max_vol_grams': total['max_vol_grams'] if total['num_vol_readings'] > 0 else 0,
+        'num_type_readings': total['num_type_readings'],
+        'max_type_thickness': total['max_type_thickness'] if total['num_type_readings'] > 0 else 0,
+        'date_last_updated': end, # Timestamp pulls (before any reading has an id watermark) continue from here
+        'last_vol_id': total['last_vol_id'],
+        'last_type_id': total['last_type_id']
+    }
+    save_distributions(stats, total['distributions'])
+    stats['salons'] = total['salons'].to_dict()
+    return stats
+
+
+def make_chunks(start, end, chunk_hours):
+    ''' Returns: list of (start, end) timestamp strings covering [start, end) '''
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(hours=chunk_hours), end)
+        chunks.append((chunk_start.strftime(TIMESTAMP_FORMAT), chunk_end.strftime(TIMESTAMP_FORMAT)))
+        chunk_start = chunk_end
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the processing stats from the full history in storage")
+    parser.add_argument('--start', required=True, help='Earliest reading to count (YYYY-MM-DD HH:MM:SS, UTC)')
+    parser.add_argument('--end', help='Count readings created before this (YYYY-MM-DD HH:MM:SS, UTC) - defaults to settle_seconds ago')
+    parser.add_argument('--chunk-hours', type=float, default=6, help='Hours of readings per chunk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Chunks pulled at the same time')
+    args = parser.parse_args()
+
+    if STATS_MODE == 'kafka':
+        parser.error("Stats are counted from the topic in kafka mode (they recount from the beginning if the datastore file is removed)")
+
+    start = datetime.strptime(args.start, TIMESTAMP_FORMAT)
+    # MySQL stores the timestamps in UTC without a timezone, so compare naive UTC times
+        # Readings newer than settle_seconds may still have lower ids being committed, so they're left for the service to pull
+    end = datetime.strptime(args.end, TIMESTAMP_FORMAT) if args.end else datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0) - timedelta(seconds=SETTLE_SECONDS)
+    chunks = make_chunks(start, end, args.chunk_hours)
+    logger.info(f"Backfill: recomputing stats from {start} to {end} in {len(chunks)} chunks with {args.workers} workers")
+
+    started = time.monotonic()
+    total = make_partial()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+        futures = [executor.submit(reduce_chunk, chunk_start, chunk_end) for chunk_start, chunk_end in chunks]
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            merge_partials(total, future.result()) # Any chunk that fails stops the backfill
+            logger.info(f"Backfill: {num_done}/{len(chunks)} chunks done")
+
+    # Written to a temp file and renamed, so the service never installs a half-written backfill
+    write_to_file(BACKFILL_FILE, make_stats(total, end.strftime(TIMESTAMP_FORMAT)))
+    logger.info(
+        f"Backfill: counted {total['num_vol_readings']} volume and {total['num_type_readings']} type readings "
+        f"in {time.monotonic() - started:.1f}s - the service installs '{BACKFILL_FILE}' on its next run"
+    )
+
+
+if __name__ == "__main__":
+    main()
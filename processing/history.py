@@ -0,0 +1,185 @@
+import math
+import base64 # For saving the ring buffers compactly
+from array import array
+from datetime import datetime, timezone
+
+
+# Fixed number of time buckets, reused in a circle
+    # Slot for a time = (time // bucket_seconds) % num_buckets, so old buckets are overwritten as time moves on
+    # Each column is a typed array, so memory is the same no matter how long the service has been running
+class RingBuffer:
+    def __init__(self, num_buckets, bucket_seconds, columns=None):
+        self.num_buckets = num_buckets
+        self.bucket_seconds = bucket_seconds
+        if columns is not None:
+            self.columns = columns
+        else:
+            self.columns = {
+                'bucket_start': array('q', [-1] * num_buckets), # Epoch seconds the slot currently holds (-1 = empty)
+                'num_vol_readings': array('q', [0] * num_buckets),
+                'min_vol_grams': array('d', [math.inf] * num_buckets),
+                'max_vol_grams': array('d', [-math.inf] * num_buckets),
+                'num_type_readings': array('q', [0] * num_buckets),
+                'min_type_thickness': array('d', [math.inf] * num_buckets),
+                'max_type_thickness': array('d', [-math.inf] * num_buckets)
+            }
+
+
+    def get_slot(self, timestamp):
+        """
+        Finds the slot for a time (epoch seconds), clearing it if it still holds an older bucket.
+        Returns: int (slot), None (time is too old for the ring)
+        """
+        bucket_start = int(timestamp // self.bucket_seconds) * self.bucket_seconds
+        slot = (bucket_start // self.bucket_seconds) % self.num_buckets
+        if self.columns['bucket_start'][slot] > bucket_start:
+            return None # Slot already holds a newer bucket
+        if self.columns['bucket_start'][slot] != bucket_start:
+            self.columns['bucket_start'][slot] = bucket_start
+            self.columns['num_vol_readings'][slot] = 0
+            self.columns['min_vol_grams'][slot] = math.inf
+            self.columns['max_vol_grams'][slot] = -math.inf
+            self.columns['num_type_readings'][slot] = 0
+            self.columns['min_type_thickness'][slot] = math.inf
+            self.columns['max_type_thickness'][slot] = -math.inf
+        return slot
+
+
+    def add_volume(self, timestamp, hair_volume):
+        slot = self.get_slot(timestamp)
+        if slot is None:
+            return
+        self.columns['num_vol_readings'][slot] += 1
+        self.columns['min_vol_grams'][slot] = min(self.columns['min_vol_grams'][slot], hair_volume)
+        self.columns['max_vol_grams'][slot] = max(self.columns['max_vol_grams'][slot], hair_volume)
+
+
+    def add_type(self, timestamp, hair_thickness):
+        slot = self.get_slot(timestamp)
+        if slot is None:
+            return
+        self.columns['num_type_readings'][slot] += 1
+        self.columns['min_type_thickness'][slot] = min(self.columns['min_type_thickness'][slot], hair_thickness)
+        self.columns['max_type_thickness'][slot] = max(self.columns['max_type_thickness'][slot], hair_thickness)
+
+
+    def add_volume_summary(self, timestamp, count, min_volume, max_volume):
+        """Adds a batch of volume readings that all fall in the same bucket"""
+        slot = self.get_slot(timestamp)
+        if slot is None or count == 0:
+            return
+        self.columns['num_vol_readings'][slot] += count
+        self.columns['min_vol_grams'][slot] = min(self.columns['min_vol_grams'][slot], min_volume)
+        self.columns['max_vol_grams'][slot] = max(self.columns['max_vol_grams'][slot], max_volume)
+
+
+    def add_type_summary(self, timestamp, count, min_thickness, max_thickness):
+        """Adds a batch of type readings that all fall in the same bucket"""
+        slot = self.get_slot(timestamp)
+        if slot is None or count == 0:
+            return
+        self.columns['num_type_readings'][slot] += count
+        self.columns['min_type_thickness'][slot] = min(self.columns['min_type_thickness'][slot], min_thickness)
+        self.columns['max_type_thickness'][slot] = max(self.columns['max_type_thickness'][slot], max_thickness)
+
+
+    def query(self, start, end):
+        """
+        Gets the buckets that start within [start, end) (epoch seconds), oldest first.
+        Looks at num_buckets slots at most, no matter how wide the range is.
+        Returns: list of bucket dicts
+        """
+        buckets = []
+        for slot in range(self.num_buckets):
+            bucket_start = self.columns['bucket_start'][slot]
+            if bucket_start < 0 or bucket_start < start or bucket_start >= end:
+                continue
+            buckets.append({
+                'bucket_start': datetime.fromtimestamp(bucket_start, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                'num_vol_readings': self.columns['num_vol_readings'][slot],
+                # None when there were no readings of that type in the bucket
+                'min_vol_grams': finite_or_none(self.columns['min_vol_grams'][slot]),
+                'max_vol_grams': finite_or_none(self.columns['max_vol_grams'][slot]),
+                'num_type_readings': self.columns['num_type_readings'][slot],
+                'min_type_thickness': finite_or_none(self.columns['min_type_thickness'][slot]),
+                'max_type_thickness': finite_or_none(self.columns['max_type_thickness'][slot])
+            })
+        buckets.sort(key=lambda bucket: bucket['bucket_start'])
+        return buckets
+
+
+    def to_dict(self):
+        return {
+            'num_buckets': self.num_buckets,
+            'bucket_seconds': self.bucket_seconds,
+            'columns': {
+                name: { 'typecode': column.typecode, 'data': base64.b64encode(column.tobytes()).decode('utf-8') }
+                for name, column in self.columns.items()
+            }
+        }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        columns = {}
+        for name, column in content['columns'].items():
+            columns[name] = array(column['typecode'])
+            columns[name].frombytes(base64.b64decode(column['data']))
+        return cls(content['num_buckets'], content['bucket_seconds'], columns)
+
+
+def finite_or_none(value):
+    return value if math.isfinite(value) else None
+
+
+# Per-minute buckets with per-hour roll-ups
+class StatsHistory:
+    RESOLUTIONS = { 'minute': 60, 'hour': 3600 }
+
+    def __init__(self, num_minutes, num_hours, rings=None):
+        if rings is not None:
+            self.rings = rings
+        else:
+            self.rings = {
+                'minute': RingBuffer(num_minutes, self.RESOLUTIONS['minute']),
+                'hour': RingBuffer(num_hours, self.RESOLUTIONS['hour'])
+            }
+
+
+    def add_volume(self, timestamp, hair_volume):
+        for ring in self.rings.values():
+            ring.add_volume(timestamp, hair_volume)
+
+
+    def add_type(self, timestamp, hair_thickness):
+        for ring in self.rings.values():
+            ring.add_type(timestamp, hair_thickness)
+
+
+    def add_volume_summary(self, timestamp, count, min_volume, max_volume):
+        for ring in self.rings.values():
+            ring.add_volume_summary(timestamp, count, min_volume, max_volume)
+
+
+    def add_type_summary(self, timestamp, count, min_thickness, max_thickness):
+        for ring in self.rings.values():
+            ring.add_type_summary(timestamp, count, min_thickness, max_thickness)
+
+
+    def query(self, start, end, resolution):
+        return self.rings[resolution].query(start, end)
+
+
+    def span(self, resolution):
+        """Returns: seconds of history the resolution can hold"""
+        ring = self.rings[resolution]
+        return ring.num_buckets * ring.bucket_seconds
+
+
+    def to_dict(self):
+        return { resolution: ring.to_dict() for resolution, ring in self.rings.items() }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(None, None, rings={ resolution: RingBuffer.from_dict(ring) for resolution, ring in content.items() })
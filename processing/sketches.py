@@ -0,0 +1,402 @@
+import math
+import random # For choosing which half of a compactor to keep
+import heapq # For finding the smallest Space-Saving counter
+import hashlib # Stable hashes for the count-min sketch (Python's hash() changes between runs)
+import base64 # For saving the count-min sketch compactly
+from array import array
+
+import numpy as np # For adding batches of values at once
+
+
+# Running count, mean and variance (Welford's algorithm)
+    # Merging uses Chan et al.'s parallel formula, so partial results can be combined exactly
+class RunningMoments:
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2 # Sum of squared differences from the mean
+
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+
+    def add_many(self, values):
+        """Add a numpy array of values (their moments are computed at once and merged in)"""
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self.merge(RunningMoments(len(values), mean, float(((values - mean) ** 2).sum())))
+
+
+    def merge(self, other):
+        """Combine another RunningMoments into this one"""
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+
+
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else 0.0
+
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+
+    def to_dict(self):
+        return { "count": self.count, "mean": self.mean, "m2": self.m2 }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(content["count"], content["mean"], content["m2"])
+
+
+# KLL quantile sketch (Karnin, Lang, Liberty)
+    # Keeps O(k) values no matter how many are added, and two sketches can be merged
+    # Level h holds values that each stand for 2^h of the values added
+class KLLSketch:
+    def __init__(self, k=200, c=2.0 / 3.0, compactors=None):
+        self.k = k
+        self.c = c
+        self.compactors = compactors if compactors is not None else [[]]
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        self.update_max_size()
+
+
+    def capacity(self, height):
+        """Lower levels hold fewer values (geometrically smaller capacity)"""
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+
+    def update_max_size(self):
+        self.max_size = sum(self.capacity(height) for height in range(len(self.compactors)))
+
+
+    def grow(self):
+        self.compactors.append([])
+        self.update_max_size()
+
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+
+    def add_many(self, values):
+        """Add a numpy array of values, compacting once they're all in instead of after each one"""
+        self.compactors[0].extend(values.tolist())
+        self.size += len(values)
+        while self.size >= self.max_size:
+            self.compress()
+
+
+    def compact(self, height):
+        """Sort a level and promote every other value (random offset) to the next level"""
+        if height + 1 >= len(self.compactors):
+            self.grow()
+        compactor = sorted(self.compactors[height])
+        # Odd one out stays at this level
+        leftover = [compactor.pop()] if len(compactor) % 2 == 1 else []
+        offset = random.randint(0, 1)
+        self.compactors[height + 1].extend(compactor[offset::2])
+        self.compactors[height] = leftover
+
+
+    def compress(self):
+        for height in range(len(self.compactors)):
+            if len(self.compactors[height]) >= self.capacity(height):
+                self.compact(height)
+                self.size = sum(len(compactor) for compactor in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+
+    def merge(self, other):
+        """Combine another KLLSketch into this one"""
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+
+    def quantile(self, q):
+        """
+        Estimates the value at quantile q (0 to 1).
+        Returns: float (estimate), None (sketch is empty)
+        """
+        weighted = sorted(
+            (value, 2 ** height) for height, compactor in enumerate(self.compactors) for value in compactor
+        )
+        if not weighted:
+            return None
+
+        total_weight = sum(weight for _, weight in weighted)
+        cumulative_weight = 0
+        for value, weight in weighted:
+            cumulative_weight += weight
+            if cumulative_weight >= q * total_weight:
+                return value
+        return weighted[-1][0]
+
+
+    def to_dict(self):
+        return { "k": self.k, "compactors": self.compactors }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(k=content["k"], compactors=[list(compactor) for compactor in content["compactors"]])
+
+
+# Mean, standard deviation and percentiles of one measurement, in constant memory
+class DistributionStats:
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self, k=200, moments=None, quantiles=None):
+        self.moments = moments if moments is not None else RunningMoments()
+        self.quantiles = quantiles if quantiles is not None else KLLSketch(k)
+
+
+    def add(self, value):
+        self.moments.add(value)
+        self.quantiles.add(value)
+
+
+    def add_many(self, values):
+        self.moments.add_many(values)
+        self.quantiles.add_many(values)
+
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.quantiles.merge(other.quantiles)
+
+
+    def summary(self, name):
+        """
+        Stats for the /stats response, e.g. name = 'vol_grams' gives mean_vol_grams, stddev_vol_grams, p50_vol_grams...
+        Returns: dict
+        """
+        summary = {
+            f"mean_{name}": self.moments.mean,
+            f"stddev_{name}": self.moments.stddev()
+        }
+        for percentile in self.PERCENTILES:
+            estimate = self.quantiles.quantile(percentile / 100)
+            summary[f"p{percentile}_{name}"] = estimate if estimate is not None else 0
+        return summary
+
+
+    def to_dict(self):
+        return { "moments": self.moments.to_dict(), "quantiles": self.quantiles.to_dict() }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(
+            moments=RunningMoments.from_dict(content["moments"]),
+            quantiles=KLLSketch.from_dict(content["quantiles"])
+        )
+
+
+# Space-Saving heavy hitters (Metwally et al.)
+    # Tracks at most `capacity` keys - when full, a new key replaces the smallest one and inherits its count as error
+    # Any key with a total above (total weight / capacity) is guaranteed to be tracked
+class SpaceSaving:
+    def __init__(self, capacity, counts=None, errors=None):
+        self.capacity = capacity
+        self.counts = counts if counts is not None else {} # Key -> estimated total (never underestimates)
+        self.errors = errors if errors is not None else {} # Key -> max overestimate
+        self.rebuild_heap()
+
+
+    def rebuild_heap(self):
+        # Heap of (count, key) - entries are stale once the key's count changes and are skipped when popped
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+
+    def pop_min(self):
+        """Removes and returns the key with the smallest count"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return key
+
+
+    def add(self, key, weight=1):
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+        else:
+            # Replace the smallest key
+            min_key = self.pop_min()
+            min_count = self.counts.pop(min_key)
+            self.errors.pop(min_key)
+            self.counts[key] = min_count + weight
+            self.errors[key] = min_count
+        heapq.heappush(self.heap, (self.counts[key], key))
+
+        # Drop stale heap entries once they outnumber the tracked keys
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
+
+
+    def merge(self, other):
+        """Combine another SpaceSaving into this one (Agarwal et al.'s mergeable summaries)"""
+        # A key missing from a full summary could have had up to its smallest count
+        self_min = min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+        other_min = min(other.counts.values()) if len(other.counts) >= other.capacity else 0
+
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, self_min) + other.counts.get(key, other_min)
+            errors[key] = self.errors.get(key, self_min) + other.errors.get(key, other_min)
+
+        # Keep the largest keys that fit
+        keys = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = { key: counts[key] for key in keys }
+        self.errors = { key: errors[key] for key in keys }
+        self.rebuild_heap()
+
+
+    def top(self, k):
+        """Returns: list of (key, estimated total, max overestimate) for the k largest keys"""
+        keys = heapq.nlargest(k, self.counts, key=self.counts.get)
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+
+    def get(self, key):
+        """Returns: (estimated total, max overestimate) if the key is tracked, None otherwise"""
+        if key not in self.counts:
+            return None
+        return self.counts[key], self.errors[key]
+
+
+    def to_dict(self):
+        return { "capacity": self.capacity, "counts": self.counts, "errors": self.errors }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(content["capacity"], dict(content["counts"]), dict(content["errors"]))
+
+
+# Count-min sketch (Cormode, Muthukrishnan)
+    # Fixed size table of totals for every key ever added - estimates never underestimate
+    # and overestimate by at most (e / width) * total weight with probability 1 - e^-depth
+class CountMinSketch:
+    def __init__(self, width, depth, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else array('d', [0.0] * (width * depth)) # depth rows of width counters
+
+
+    def positions(self, key):
+        # Two hashes from one digest, combined for each row (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (hash1 + row * hash2) % self.width for row in range(self.depth)]
+
+
+    def add(self, key, weight=1):
+        for position in self.positions(key):
+            self.table[position] += weight
+
+
+    def estimate(self, key):
+        return min(self.table[position] for position in self.positions(key))
+
+
+    def merge(self, other):
+        for position in range(len(self.table)):
+            self.table[position] += other.table[position]
+
+
+    def to_dict(self):
+        return {
+            "width": self.width,
+            "depth": self.depth,
+            "table": base64.b64encode(self.table.tobytes()).decode('utf-8')
+        }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        table = array('d')
+        table.frombytes(base64.b64decode(content["table"]))
+        return cls(content["width"], content["depth"], table)
+
+
+# Per-salon hair volume totals in bounded memory
+    # Space-Saving answers top producers, the count-min sketch answers any salon (including the long tail)
+class SalonStats:
+    def __init__(self, capacity, width, depth, top_salons=None, all_salons=None):
+        self.top_salons = top_salons if top_salons is not None else SpaceSaving(capacity)
+        self.all_salons = all_salons if all_salons is not None else CountMinSketch(width, depth)
+
+
+    def add(self, salon_id, hair_volume):
+        self.top_salons.add(salon_id, hair_volume)
+        self.all_salons.add(salon_id, hair_volume)
+
+
+    def add_many(self, salon_ids, hair_volumes):
+        """Add a batch of readings (numpy arrays), totalled per salon first so each salon is only added once"""
+        unique_salon_ids, salon_indexes = np.unique(salon_ids, return_inverse=True)
+        totals = np.bincount(salon_indexes, weights=hair_volumes)
+        for salon_id, total in zip(unique_salon_ids.tolist(), totals.tolist()):
+            self.add(salon_id, total)
+
+
+    def merge(self, other):
+        self.top_salons.merge(other.top_salons)
+        self.all_salons.merge(other.all_salons)
+
+
+    def top(self, k):
+        return [
+            { "salon_id": salon_id, "total_vol_grams": total, "max_error_grams": error }
+            for salon_id, total, error in self.top_salons.top(k)
+        ]
+
+
+    def get(self, salon_id):
+        # Heavy hitters are tracked closely - use whichever estimate is tighter
+        estimate = self.all_salons.estimate(salon_id)
+        tracked = self.top_salons.get(salon_id)
+        if tracked is not None and tracked[0] < estimate:
+            return { "salon_id": salon_id, "total_vol_grams": tracked[0], "max_error_grams": tracked[1] }
+        return { "salon_id": salon_id, "total_vol_grams": estimate, "max_error_grams": None }
+
+
+    def to_dict(self):
+        return { "top_salons": self.top_salons.to_dict(), "all_salons": self.all_salons.to_dict() }
+
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(
+            None, None, None,
+            top_salons=SpaceSaving.from_dict(content["top_salons"]),
+            all_salons=CountMinSketch.from_dict(content["all_salons"])
+        )
@@ -5,6 +5,7 @@ import json # For data operations
 from datetime import datetime, timezone # For creating and formatting timestamps and converting timezones
 import time # For kafka sleep
 import random
+import queue # For delivery report timeouts
 
 import uuid # For creating trace identifiers
 
@@ -18,6 +19,9 @@ from pykafka import KafkaClient # For message brokering
 from pykafka.common import OffsetType
 from pykafka.exceptions import KafkaException
 
+# Heartbeats to the monitors (shared with the other services)
+from common.heartbeat import setup_heartbeat_thread
+
 
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -26,6 +30,16 @@ with open('config/app_conf.yaml', 'r') as f:
 # VOLUME_URL = app_config['events']['volume']['url']
 # TYPE_URL = app_config['events']['type']['url']
 
+# Producer settings (async mode queues a whole batch and waits once for delivery reports)
+PRODUCER_CONFIG = app_config['events'].get('producer', {})
+PRODUCER_ASYNC = PRODUCER_CONFIG.get('async', False)
+PRODUCER_LINGER_MS = PRODUCER_CONFIG.get('linger_ms', 5)
+PRODUCER_MAX_BATCH_SIZE = PRODUCER_CONFIG.get('max_batch_size', 500)
+DELIVERY_TIMEOUT = PRODUCER_CONFIG.get('delivery_timeout', 10) # Seconds to wait for a batch to be acknowledged
+
+# Heartbeats to the monitors (optional - for health/check in heartbeat monitor mode)
+HEARTBEAT_ENABLED = app_config['heartbeat']['enabled']
+
 
 with open("config/log_conf.yaml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -126,7 +140,18 @@ class KafkaWrapper:
         
         try:
             topic_for_producer = self.client.topics[self.topic]
-            self.producer = topic_for_producer.get_sync_producer()
+            if PRODUCER_ASYNC:
+                # Queue messages and send them to the broker in batches
+                    # Delivery reports let produce_batch() know when every message has been acknowledged
+                self.producer = topic_for_producer.get_producer(
+                    sync=False,
+                    delivery_reports=True,
+                    linger_ms=PRODUCER_LINGER_MS, # Max time a message waits in the queue before being sent
+                    min_queued_messages=PRODUCER_MAX_BATCH_SIZE # Send as soon as this many messages are queued
+                )
+            else:
+                self.producer = topic_for_producer.get_sync_producer()
+            return True
         except KafkaException as e: # Will be triggered if Kafka is down
             msg = f"Make error when making producer: {e}"
             logger.warning(msg)
@@ -179,6 +204,90 @@ class KafkaWrapper:
                 self.connect()
 
 
+    def queue_messages(self, messages, producer=None, queued=None):
+        """
+        Queue messages on the async producer without waiting on the broker.
+        producer, queued: messages of the batch that are already queued (still waiting for delivery)
+        If Kafka has been reconnected since, the old producer's delivery reports will never arrive,
+        so its messages are queued again on the new producer (they can be sent twice).
+        Returns: (producer, dict of id -> pykafka Message for every message of the batch queued on it)
+        """
+
+        queued = dict(queued or {})
+        remaining = list(messages)
+        while True: # Runs until everything is queued on the current producer
+            if self.producer is None:
+                self.connect() # Try to create/reconnect client, consumer, and producer
+            if self.producer is not producer:
+                remaining = [queued_msg.value for queued_msg in queued.values()] + remaining
+                producer, queued = self.producer, {}
+
+            try:
+                while remaining:
+                    queued_msg = producer.produce(remaining[0])
+                    queued[id(queued_msg)] = queued_msg
+                    remaining.pop(0)
+                return producer, queued
+            except KafkaException as e:
+                # Reset client, consumer, and producer and attempt to reconnect
+                logger.warning(f"Kafka issue in producer: {e}")
+                self.client = None
+                self.consumer = None
+                self.producer = None
+
+
+    def produce_batch(self, messages):
+        """
+        Produce a list of messages and wait for all of them to be delivered (DELIVERY_TIMEOUT for the whole batch).
+        Messages that fail to be delivered are produced again.
+        Returns: True (whole batch delivered), False (timed out waiting for delivery)
+        """
+
+        if not PRODUCER_ASYNC:
+            # Sync producer already waits for each message to be delivered
+            for message in messages:
+                self.produce(message)
+            return True
+
+        deadline = time.monotonic() + DELIVERY_TIMEOUT
+        if self.producer is not None:
+            # Delivery reports are per thread, and server threads are reused between requests
+                # Reports left on this thread by an earlier batch (e.g. one that timed out) are thrown away
+            drain_delivery_reports(self.producer)
+
+        producer, pending = self.queue_messages(messages)
+        while pending:
+            if self.producer is not producer:
+                # Kafka was reconnected by another request - queue what's still pending on the new producer
+                producer, pending = self.queue_messages([], producer, pending)
+                continue
+
+            try:
+                delivered_msg, exc = producer.get_delivery_report(block=True, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                logger.error(f"Timed out waiting for delivery of {len(pending)} of {len(messages)} messages")
+                return False
+
+            if pending.get(id(delivered_msg)) is not delivered_msg:
+                continue # Late report for a message from an earlier batch on this thread
+            del pending[id(delivered_msg)]
+
+            if exc is not None:
+                logger.warning(f"Failed to deliver message, retrying: {exc}")
+                producer, pending = self.queue_messages([delivered_msg.value], producer, pending)
+
+        return True
+
+
+def drain_delivery_reports(producer):
+    """Throw away the delivery reports waiting on this thread's queue"""
+    while True:
+        try:
+            producer.get_delivery_report(block=False)
+        except queue.Empty:
+            return
+
+
 # Create a KafkaWrapper instance (has connection failure handling) globally
 kafka_wrapper = KafkaWrapper(
     f"{app_config['events']['hostname']}:{app_config['events']['port']}", # host
@@ -189,6 +298,8 @@ kafka_wrapper = KafkaWrapper(
 # API endpoint functions
 def report_hair_volume_readings(body):
     # Write to database
+    messages = [] # Encoded Kafka messages for the whole batch
+    trace_ids = []
     for reading in body["readings"]:
         trace_id = str(uuid.uuid4())
         # Make request message that matches what storage will take
@@ -210,9 +321,16 @@ def report_hair_volume_readings(body):
         "payload": request_message
         }
         msg_str = json.dumps(msg)
-        kafka_wrapper.produce(msg_str.encode('utf-8'))
+        messages.append(msg_str.encode('utf-8'))
+        trace_ids.append(trace_id)
 
         # logger.debug(f"volume_reading msg: {msg_str.encode('utf-8')}")
+
+    # Send the whole batch to Kafka and only respond once every reading has been delivered
+    if not kafka_wrapper.produce_batch(messages):
+        return { "message": "Timed out waiting for volume_reading events to be delivered" }, 503
+
+    for trace_id in trace_ids:
         logger.info(f"Response for event volume_reading (id: {trace_id}) has status 201")
 
     return NoContent, 201
@@ -220,6 +338,8 @@ def report_hair_volume_readings(body):
 
 def report_hair_type_readings(body):
     # Write to database by sending request to stoage's app.py
+    messages = [] # Encoded Kafka messages for the whole batch
+    trace_ids = []
     for reading in body["readings"]:
         trace_id = str(uuid.uuid4())
         # Make request message that matches what storage will take
@@ -242,9 +362,16 @@ def report_hair_type_readings(body):
         "payload": request_message
         }
         msg_str = json.dumps(msg)
-        kafka_wrapper.produce(msg_str.encode('utf-8'))
+        messages.append(msg_str.encode('utf-8'))
+        trace_ids.append(trace_id)
 
         # logger.debug(f"type_reading msg: {msg_str.encode('utf-8')}")
+
+    # Send the whole batch to Kafka and only respond once every reading has been delivered
+    if not kafka_wrapper.produce_batch(messages):
+        return { "message": "Timed out waiting for type_reading events to be delivered" }, 503
+
+    for trace_id in trace_ids:
         logger.info(f"Response for event type_reading (id: {trace_id}) has status 201")
 
     return NoContent, 201
@@ -267,8 +394,14 @@ def get_check():
     return {"status_datetime": status_datetime}, 200 # If service is running, then it will return 200 (OK)
 
 
+def get_heartbeat_counters():
+    return get_check()[0] # Same fields as /check
+
+
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("config/hair-api-1.0.0-swagger.yaml", strict_validation=True, validate_responses=True)
 
 if __name__ == "__main__":    
+    if HEARTBEAT_ENABLED:
+        setup_heartbeat_thread("receiver", get_heartbeat_counters, app_config['heartbeat'])
     app.run(port=8080, host="0.0.0.0")
\ No newline at end of file
@@ -1,16 +1,19 @@
 import connexion
 from connexion import NoContent
+from flask import Response # For streaming responses
 
 import json # For data operations
+import base64 # For encoding page cursors
 import datetime # For creating timestamps and datetime object conversions
 import time # For kafka sleep
 import random
 
 # SQLAlchemy and database modules
-from models import Volume, Type # From models.py, my tables
+from models import Volume, Type, EventCount # From models.py, my tables
 import create_database as cd # From create_database.py, for creating sessions
 from functools import wraps # For handling session management automatically
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, or_, and_, func
+from sqlalchemy.exc import SQLAlchemyError
 
 import yaml # For using the yaml config file (app_conf)
 
@@ -26,10 +29,16 @@ from pykafka.exceptions import KafkaException
 # Threading
 from threading import Thread
 
+# Heartbeats to the monitors (shared with the other services)
+from common.heartbeat import setup_heartbeat_thread
+
 # Setting app configurations
 with open('config/app_conf.yaml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
+# Heartbeats to the monitors (optional - for health/check in heartbeat monitor mode)
+HEARTBEAT_ENABLED = app_config['heartbeat']['enabled']
+
 # Logging configurations
 with open("config/log_conf.yaml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -37,6 +46,21 @@ with open("config/log_conf.yaml", "r") as f:
 
 logger = logging.getLogger('basicLogger')
 
+# Micro-batching settings for the Kafka consumer's database writes
+BATCH_MAX_ROWS = app_config['batch']['max_rows']
+BATCH_MAX_WAIT_MS = app_config['batch']['max_wait_ms']
+
+# Rows fetched from the database at a time when streaming a range query
+STREAM_CHUNK_SIZE = app_config['streaming']['chunk_size']
+
+# How often the event counters are checked against the real table counts (seconds)
+COUNTS_RECONCILE_INTERVAL = app_config['counters']['reconcile_interval']
+
+# Consumer group settings (balanced mode shares the topic's partitions between storage replicas)
+CONSUMER_CONFIG = app_config['events'].get('consumer', {})
+CONSUMER_MODE = CONSUMER_CONFIG.get('mode', 'simple') # 'balanced' or 'simple'
+CONSUMER_GROUP = str.encode(CONSUMER_CONFIG.get('group', 'storage'))
+
 
 # Message Brokering
 # Create class for managing Kafka connections (client and consumer)
@@ -103,10 +127,24 @@ class KafkaWrapper:
             # (uncommitted messages) when the service re-starts (i.e., it doesn't
             # read all the old messages from the history in the message queue).
             topic = self.client.topics[self.topic]
-            self.consumer = topic.get_simple_consumer(
-                reset_offset_on_start=False, # Don't read old messages
-                auto_offset_reset=OffsetType.LATEST # Read only new messages
-            )
+            if CONSUMER_MODE == 'balanced':
+                # Join the consumer group - Kafka assigns each storage replica its own partitions
+                    # Offsets are only committed after the rows are written (see commit_offsets())
+                self.consumer = topic.get_balanced_consumer(
+                    consumer_group=CONSUMER_GROUP,
+                    managed=True, # Group membership is coordinated by Kafka (no ZooKeeper connection needed)
+                    auto_commit_enable=False, # Don't commit offsets for messages that aren't stored yet
+                    reset_offset_on_start=False, # Resume from the group's committed offsets
+                    auto_offset_reset=OffsetType.LATEST, # Read only new messages if the group has no committed offsets
+                    consumer_timeout_ms=BATCH_MAX_WAIT_MS # Stop iterating when idle so buffered rows can be flushed
+                )
+            else:
+                self.consumer = topic.get_simple_consumer(
+                    reset_offset_on_start=False, # Don't read old messages
+                    auto_offset_reset=OffsetType.LATEST, # Read only new messages
+                    consumer_timeout_ms=BATCH_MAX_WAIT_MS # Stop iterating when idle so buffered rows can be flushed
+                )
+            return True
         except KafkaException as e: # Will be triggered if Kafka is down
             msg = f"Make error when making consumer: {e}"
             logger.warning(msg)
@@ -151,7 +189,8 @@ class KafkaWrapper:
             try:
                 for msg in self.consumer:
                     yield msg # To be used in process_messages()
-                    # self.consumer.commit_offsets() # Tell kafka that this message has been consumed
+                # Consumer timed out with no new messages
+                yield None # Lets process_messages() flush any buffered rows
             # If any error occurs, keep trying
             except KafkaException as e:
                 # Reset client, consumer, and producer and attempt to reconnect
@@ -163,6 +202,23 @@ class KafkaWrapper:
                 self.connect()
 
 
+    def commit_offsets(self):
+        """
+        Tell Kafka that every message consumed so far has been stored.
+        Only called after the database transaction commits, so a restart or rebalance
+        resumes from the first message that wasn't written.
+        """
+
+        if CONSUMER_MODE != 'balanced' or self.consumer is None:
+            return # Simple consumer doesn't belong to a consumer group
+
+        try:
+            self.consumer.commit_offsets()
+        except KafkaException as e:
+            # Uncommitted messages will be consumed again after reconnecting
+            logger.warning(f"Kafka issue when committing offsets: {e}")
+
+
     def produce(self, message):
         """Produce from messages - retry if it doesn't work"""
 
@@ -186,16 +242,17 @@ class KafkaWrapper:
 
 # SQLAlchemy functions
 # Handles session management automatically
+    # One scoped session per request thread, returned to the pool when the function is done
 def use_db_session(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        session = cd.make_session()
+        session = cd.ScopedSession()
         try:
             # Wrapper function
                 # Call the original (decorated) function with session injected as the first argument
             return func(session, *args, **kwargs)
         finally:
-            session.close()
+            cd.ScopedSession.remove()
     return wrapper
 
 
@@ -206,46 +263,339 @@ def convert_str_timestamp_to_datetime(timestamp):
     return timestamp_truncated
 
 
-def get_hair_volume_readings(start_timestamp, end_timestamp):
-    session = cd.make_session()
+# Keyset pagination helpers
+    # A cursor is the (date_created, id) of the last row on the previous page, encoded so clients treat it as opaque
+def encode_cursor(date_created, row_id):
+    cursor = json.dumps({"date_created": date_created.strftime("%Y-%m-%d %H:%M:%S"), "id": row_id})
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a page cursor.
+    Returns: (date_created, id) (valid cursor), None (invalid cursor)
+    """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        return convert_str_timestamp_to_datetime(decoded["date_created"]), int(decoded["id"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def make_row_filters(model, start_timestamp, end_timestamp, after_id):
+    """
+    Builds the WHERE conditions for the readings to return.
+        after_id: rows with a greater id (primary key range scan - exact watermark for incremental pulls),
+            created before end_timestamp if it's given (so rows still being committed aren't passed by the watermark)
+        otherwise: rows created within [start_timestamp, end_timestamp)
+    Returns: (list of conditions, error message)
+    """
+    if after_id is not None:
+        filters = [model.id > after_id]
+        if end_timestamp is not None:
+            filters.append(model.date_created < datetime.datetime.strptime(end_timestamp, "%Y-%m-%d %H:%M:%S"))
+        return filters, None
+
+    if start_timestamp is None or end_timestamp is None:
+        return None, "start_timestamp and end_timestamp are required when after_id isn't given"
 
     start = datetime.datetime.strptime(start_timestamp, "%Y-%m-%d %H:%M:%S")
-    print(f"hair volume reading start timestamp: {str(start)}")
     end = datetime.datetime.strptime(end_timestamp, "%Y-%m-%d %H:%M:%S")
-    print(f"hair volume reading start timestamp: {str(end)}")
+    return [model.date_created >= start, model.date_created < end], None
+
+
+def make_range_statement(model, start_timestamp, end_timestamp, after_id, limit, cursor):
+    """
+    Builds the query for readings, ordered by id (after_id) or by (date_created, id) (timestamps).
+    Returns: (statement, error message)
+    """
+    filters, error = make_row_filters(model, start_timestamp, end_timestamp, after_id)
+    if error is not None:
+        return None, error
+
+    statement = select(model).where(*filters)
+
+    if after_id is not None:
+        # Pages continue from the X-Last-Id header, so no cursor is needed
+        statement = statement.order_by(model.id)
+    else:
+        if cursor is not None:
+            last_row = decode_cursor(cursor)
+            if last_row is None:
+                return None, f"Invalid cursor: {cursor}"
+            last_date_created, last_id = last_row
+            # Continue after the last row of the previous page (index range scan on date_created)
+            statement = statement.where(or_(
+                model.date_created > last_date_created,
+                and_(model.date_created == last_date_created, model.id > last_id)
+            ))
+        # Same order as the date_created index so pages are consistent
+        statement = statement.order_by(model.date_created, model.id)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return statement, None
+
+
+@use_db_session
+def get_readings(session, model, start_timestamp, end_timestamp, after_id, limit, cursor):
+    """
+    Gets readings for a table within the timestamps (or after an id), one page at a time if a limit is given.
+    Returns: (list of reading dicts, response headers, error message or None)
+    """
+    statement, error = make_range_statement(model, start_timestamp, end_timestamp, after_id, limit, cursor)
+    if error is not None:
+        return None, None, error
+
+    rows = session.execute(statement).scalars().all()
+    results = [row.to_dict() for row in rows]
+
+    # Paging/watermark info is sent as headers so the body stays a list of readings
+    headers = {}
+    if rows:
+        headers["X-Last-Id"] = str(max(row.id for row in rows)) # Next after_id for incremental pulls
+    # A full page means there may be more rows after it
+    if after_id is None and limit is not None and len(rows) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].date_created, rows[-1].id)
+
+    logger.debug("Found %d %s readings (start: %s, end: %s, after id: %s)", len(results), model.__tablename__, start_timestamp, end_timestamp, after_id)
+
+    return results, headers, None
+
+
+# Convert datetime values when writing readings as JSON
+def serialize_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def stream_readings(model, start_timestamp, end_timestamp, after_id, limit, cursor):
+    """
+    Streams readings within the timestamps (or after an id) as NDJSON (one reading per line).
+    Rows are read from a server-side cursor, so memory use doesn't grow with the size of the time range.
+    """
+    statement, error = make_range_statement(model, start_timestamp, end_timestamp, after_id, limit, cursor)
+    if error is not None:
+        return { "message": error }, 400
+
+    def generate():
+        # Session stays open until the last row has been sent
+        session = cd.make_session()
+        try:
+            # yield_per streams results from the database STREAM_CHUNK_SIZE rows at a time
+            result = session.execute(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+            num_rows = 0
+            for row in result.scalars():
+                yield json.dumps(row.to_dict(), default=serialize_datetime) + "\n"
+                num_rows += 1
+            logger.debug("Streamed %d %s readings (start: %s, end: %s, after id: %s)", num_rows, model.__tablename__, start_timestamp, end_timestamp, after_id)
+        finally:
+            session.close()
 
-    statement = select(Volume).where(Volume.date_created >= start).where(Volume.date_created < end)
+    return Response(generate(), status=200, mimetype="application/x-ndjson")
 
-    results = [
-        result.to_dict() for result in session.execute(statement).scalars().all()
-    ]
 
-    session.close()
+def get_hair_volume_readings(start_timestamp=None, end_timestamp=None, after_id=None, limit=None, cursor=None, format="json"):
+    if format == "ndjson":
+        return stream_readings(Volume, start_timestamp, end_timestamp, after_id, limit, cursor)
 
-    logger.debug("Found %d hair volume readings (start: %s, end: %s)", len(results), start, end)
+    results, headers, error = get_readings(Volume, start_timestamp, end_timestamp, after_id, limit, cursor)
+    if error is not None:
+        return { "message": error }, 400
 
-    return results
+    return results, 200, headers
 
 
-def get_hair_type_readings(start_timestamp, end_timestamp):
-    session = cd.make_session()
+def get_hair_type_readings(start_timestamp=None, end_timestamp=None, after_id=None, limit=None, cursor=None, format="json"):
+    if format == "ndjson":
+        return stream_readings(Type, start_timestamp, end_timestamp, after_id, limit, cursor)
+
+    results, headers, error = get_readings(Type, start_timestamp, end_timestamp, after_id, limit, cursor)
+    if error is not None:
+        return { "message": error }, 400
+
+    return results, 200, headers
+
+
+# Aggregate helpers
+# MySQL DATE_FORMAT patterns for grouping readings into time buckets
+TIME_BUCKET_FORMATS = {
+    "minute": "%Y-%m-%d %H:%i:00",
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00"
+}
+
+
+def make_aggregate_dict(count, minimum, maximum, total, total_of_squares):
+    # MySQL returns NULL for min/max/sum when there are no rows
+    return {
+        "count": count,
+        "min": float(minimum) if minimum is not None else None,
+        "max": float(maximum) if maximum is not None else None,
+        "sum": float(total) if total is not None else 0.0,
+        "sum_of_squares": float(total_of_squares) if total_of_squares is not None else 0.0
+    }
+
+
+@use_db_session
+def get_aggregate(session, model, column, start_timestamp, end_timestamp, after_id, group_by):
+    """
+    Computes count, min, max, sum and sum of squares of a column in SQL for readings within the timestamps (or after an id).
+    Optionally also grouped by salon_id or by time bucket (minute, hour, day).
+    Returns: (dict of aggregates, error message or None)
+    """
+    filters, error = make_row_filters(model, start_timestamp, end_timestamp, after_id)
+    if error is not None:
+        return None, error
+
+    aggregates = [func.count(column), func.min(column), func.max(column), func.sum(column), func.sum(column * column)]
+
+    # Highest id aggregated is computed in the same statement, so it's an exact watermark for the next after_id pull
+    statement = select(*aggregates, func.max(model.id)).where(*filters)
+    row = session.execute(statement).one()
+    result = make_aggregate_dict(*row[:-1])
+    result["last_id"] = row[-1] if row[-1] is not None else after_id
+
+    if group_by is not None:
+        if group_by == "salon_id":
+            key = model.salon_id
+        else:
+            key = func.date_format(model.date_created, TIME_BUCKET_FORMATS[group_by])
+        statement = select(key, *aggregates).where(*filters).group_by(key).order_by(key)
+        result["groups"] = [
+            { "key": row[0], **make_aggregate_dict(*row[1:]) } for row in session.execute(statement).all()
+        ]
+
+    logger.debug("Aggregated %d %s readings (start: %s, end: %s, after id: %s, group by: %s)", result["count"], model.__tablename__, start_timestamp, end_timestamp, after_id, group_by)
+
+    return result, None
+
+
+def get_hair_volume_aggregate(start_timestamp=None, end_timestamp=None, after_id=None, group_by=None):
+    result, error = get_aggregate(Volume, Volume.hair_volume, start_timestamp, end_timestamp, after_id, group_by)
+    if error is not None:
+        return { "message": error }, 400
+    return result, 200
+
+
+def get_hair_type_aggregate(start_timestamp=None, end_timestamp=None, after_id=None, group_by=None):
+    result, error = get_aggregate(Type, Type.hair_thickness, start_timestamp, end_timestamp, after_id, group_by)
+    if error is not None:
+        return { "message": error }, 400
+    return result, 200
 
-    start = datetime.datetime.strptime(start_timestamp, "%Y-%m-%d %H:%M:%S")
-    print(f"hair type reading start timestamp: {str(start)}")
-    end = datetime.datetime.strptime(end_timestamp, "%Y-%m-%d %H:%M:%S")
-    print(f"hair type reading end timestamp: {str(start)}")
 
-    statement = select(Type).where(Type.date_created >= start).where(Type.date_created < end)
+# Buffers decoded readings and writes them to the database in batches
+class BatchWriter:
+    def __init__(self, max_rows, max_wait_ms):
+        self.max_rows = max_rows
+        self.max_wait_ms = max_wait_ms
+        self.session = cd.make_session() # One long-lived session for the consumer thread (closed in close())
+        self.rows = { Volume: [], Type: [] } # Rows waiting to be inserted, per table
+        self.trace_ids = { Volume: [], Type: [] } # For logging once the rows are stored
+        self.first_buffered_time = None # When the oldest row in the buffer was added
 
-    results = [
-        result.to_dict() for result in session.execute(statement).scalars().all()
-    ]
 
-    session.close()
+    def close(self):
+        """Return the consumer session's connection to the pool"""
+        self.session.close()
 
-    logger.debug("Found %d hair type readings (start: %s, end: %s)", len(results), start, end)
 
-    return results
+    def add(self, model, row, trace_id):
+        """Buffer a row (dict of column values) for the given table"""
+
+        if self.first_buffered_time is None:
+            self.first_buffered_time = time.monotonic()
+        self.rows[model].append(row)
+        self.trace_ids[model].append(trace_id)
+
+
+    def num_buffered(self):
+        return len(self.rows[Volume]) + len(self.rows[Type])
+
+
+    def should_flush(self):
+        """
+        Checks if the buffer is full or the oldest buffered row has waited too long.
+        Returns: True (flush now), False (keep buffering)
+        """
+
+        if self.num_buffered() == 0:
+            return False
+        if self.num_buffered() >= self.max_rows:
+            return True
+        waited_ms = (time.monotonic() - self.first_buffered_time) * 1000
+        return waited_ms >= self.max_wait_ms
+
+
+    def flush(self):
+        """Insert all buffered rows in one transaction - retry until the database accepts them"""
+
+        if self.num_buffered() == 0:
+            return
+
+        while True: # Blocks consuming until the batch is stored (don't drop events if the database is down)
+            try:
+                for model, rows in self.rows.items():
+                    if rows:
+                        # One multi-row INSERT per table
+                            # IGNORE skips readings that are already stored (unique trace_id), since Kafka can
+                            # deliver a message again if the consumer restarts or rebalances before committing offsets
+                        result = self.session.execute(insert(model).prefix_with("IGNORE").values(rows))
+                        # Update the table's counter in the same transaction (only rows that were actually inserted)
+                        self.session.execute(
+                            update(EventCount)
+                            .where(EventCount.table_name == model.__tablename__)
+                            .values(count=EventCount.count + result.rowcount)
+                        )
+                self.session.commit()
+                break
+            except SQLAlchemyError as e:
+                self.session.rollback()
+                logger.error(f"Failed to store batch of {self.num_buffered()} readings: {e}")
+                # Sleeps for a random amount of time (0.5 to 1.5s)
+                time.sleep(random.randint(500, 1500) / 1000)
+
+        logger.info(f"Stored batch of {len(self.rows[Volume])} volume_reading and {len(self.rows[Type])} type_reading events")
+        for trace_id in self.trace_ids[Volume]:
+            logger.info(f"Stored event volume_reading with a trace id of {trace_id}")
+        for trace_id in self.trace_ids[Type]:
+            logger.info(f"Stored event type_reading with a trace id of {trace_id}")
+
+        # Empty the buffer
+        self.rows = { Volume: [], Type: [] }
+        self.trace_ids = { Volume: [], Type: [] }
+        self.first_buffered_time = None
+
+
+# Convert Kafka message payloads into rows for the database tables
+def make_volume_row(payload):
+    return {
+        'salon_id': payload['salon_id'],
+        'salon_name': payload['salon_name'],
+        'hair_volume': payload['hair_volume'],
+        'disposal_method': payload['disposal_method'],
+        # Convert timestamp from string to Python datetime object using strptime
+            # Also modified original format of timestamps being sent through the yaml file example
+        'batch_timestamp': datetime.datetime.strptime(payload['batch_timestamp'], "%Y-%m-%d %H:%M:%S"),
+        'reading_timestamp': datetime.datetime.strptime(payload['reading_timestamp'], "%Y-%m-%d %H:%M:%S"),
+        'trace_id': payload['trace_id']
+    }
+
+
+def make_type_row(payload):
+    return {
+        'salon_id': payload['salon_id'],
+        'salon_name': payload['salon_name'],
+        'hair_colour': payload['hair_colour'],
+        'hair_texture': payload['hair_texture'],
+        'hair_thickness': payload['hair_thickness'],
+        'batch_timestamp': datetime.datetime.strptime(payload['batch_timestamp'], "%Y-%m-%d %H:%M:%S"),
+        'reading_timestamp': datetime.datetime.strptime(payload['reading_timestamp'], "%Y-%m-%d %H:%M:%S"),
+        'trace_id': payload['trace_id']
+    }
 
 
 def process_messages():
@@ -255,47 +605,34 @@ def process_messages():
         f"{app_config['events']['hostname']}:{app_config['events']['port']}", # host
         str.encode(app_config['events']['topic']) # topic
     )
+    batch_writer = BatchWriter(BATCH_MAX_ROWS, BATCH_MAX_WAIT_MS)
 
+    try:
+        consume_messages(kafka_wrapper, batch_writer)
+    finally:
+        batch_writer.close()
+
+
+def consume_messages(kafka_wrapper, batch_writer):
+    """ Buffer every consumed message in the batch writer and flush it when it's full or has waited too long"""
     for msg in kafka_wrapper.messages():
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-
-        if msg["type"] == "volume_reading":
-            # Store the volume_reading (i.e., the payload) to the DB
-            session = cd.make_session()
-            hair_vol_reading_event = Volume(
-                salon_id = payload['salon_id'],
-                salon_name = payload['salon_name'],
-                hair_volume = payload['hair_volume'],
-                disposal_method = payload['disposal_method'],
-                # Convert timestamp from string to Python datetime object using strptime
-                    # Also modified original format of timestamps being sent through the yaml file example
-                batch_timestamp = datetime.datetime.strptime(payload['batch_timestamp'], "%Y-%m-%d %H:%M:%S"),
-                reading_timestamp = datetime.datetime.strptime(payload['reading_timestamp'], "%Y-%m-%d %H:%M:%S"),
-                trace_id = payload['trace_id']
-            )
-            session.add(hair_vol_reading_event)
-            session.commit()
-            logger.info(f"Stored event volume_reading with a trace id of {payload['trace_id']}")
-
-        elif msg["type"] == "type_reading":
-            # Store the type_reading (i.e., the payload) to the DB
-            session = cd.make_session()
-            hair_type_reading_event = Type(
-                salon_id = payload['salon_id'],
-                salon_name = payload['salon_name'],
-                hair_colour = payload['hair_colour'],
-                hair_texture = payload['hair_texture'],
-                hair_thickness = payload['hair_thickness'],
-                batch_timestamp = datetime.datetime.strptime(payload['batch_timestamp'], "%Y-%m-%d %H:%M:%S"),
-                reading_timestamp = datetime.datetime.strptime(payload['reading_timestamp'], "%Y-%m-%d %H:%M:%S"),
-                trace_id = payload['trace_id']
-            )
-            session.add(hair_type_reading_event)
-            session.commit()
-            logger.info(f"Stored event type_reading with a trace id of {payload['trace_id']}")
+        if msg is not None: # None means the consumer was idle
+            msg_str = msg.value.decode('utf-8')
+            msg = json.loads(msg_str)
+            logger.debug("Message: %s" % msg)
+            payload = msg["payload"]
+
+            if msg["type"] == "volume_reading":
+                # Buffer the volume_reading (i.e., the payload) to be stored in the DB
+                batch_writer.add(Volume, make_volume_row(payload), payload['trace_id'])
+            elif msg["type"] == "type_reading":
+                # Buffer the type_reading (i.e., the payload) to be stored in the DB
+                batch_writer.add(Type, make_type_row(payload), payload['trace_id'])
+
+        if batch_writer.should_flush():
+            batch_writer.flush()
+            # Rows are committed in the database, so their messages can be marked as consumed
+            kafka_wrapper.commit_offsets()
 
 
 # Endpoint function for checking health of this service
@@ -304,33 +641,92 @@ def get_health():
     return {"status": "Running"}, 200 # If service is running, then it will return 200 which means it's ok
 
 
-def get_event_stats():
+@use_db_session
+def get_event_stats(session):
     ''' 
         Counts number of events of each event type in the database
+            Reads the counters kept by the Kafka consumer instead of counting every row
 
         Returns:
             dict: int (2)
     '''
-    session = cd.make_session()
-
-    num_volume_readings = session.query(Volume).count()
-    num_type_readings = session.query(Type).count()
-
-    session.close()
+    counts = { row.table_name: row.count for row in session.execute(select(EventCount)).scalars() }
+    for model in [Volume, Type]:
+        # Counter hasn't been seeded yet (reconcile_counts() hasn't run), fall back to counting rows
+        if model.__tablename__ not in counts:
+            counts[model.__tablename__] = session.query(model).count()
+    num_volume_readings = counts[Volume.__tablename__]
+    num_type_readings = counts[Type.__tablename__]
 
     logger.info("Found %d hair volume readings and %d hair type readings", num_volume_readings, num_type_readings)
 
     return { "num_vol": num_volume_readings, "num_type": num_type_readings }, 200
 
 
+@use_db_session
+def reconcile_counts(session):
+    ''' Seeds missing event counters and corrects any that have drifted from the real table counts '''
+    try:
+        for model in [Volume, Type]:
+            # Lock the counter row so the consumer can't update it while the table is being counted
+            counter = session.execute(
+                select(EventCount).where(EventCount.table_name == model.__tablename__).with_for_update()
+            ).scalar_one_or_none()
+            actual_count = session.query(model).count()
+
+            if counter is None:
+                session.add(EventCount(table_name=model.__tablename__, count=actual_count))
+                logger.info(f"Seeded {model.__tablename__} counter with {actual_count} readings")
+            elif counter.count != actual_count:
+                logger.warning(f"{model.__tablename__} counter drifted ({counter.count} counted, {actual_count} stored), correcting it")
+                counter.count = actual_count
+            session.commit()
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.error(f"Failed to reconcile event counters: {e}")
+
+
+def get_pool_stats():
+    ''' 
+        Gets database connection pool usage and how long checkouts waited for a connection
+
+        Returns:
+            dict: pool metrics
+    '''
+    pool_stats = cd.get_pool_metrics()
+    logger.debug(f"Pool stats: {pool_stats}")
+    return pool_stats, 200
+
+
+def reconcile_counts_periodically():
+    while True: # Runs infinitely
+        time.sleep(COUNTS_RECONCILE_INTERVAL)
+        reconcile_counts()
+
+
 def setup_kafka_thread():
     t1 = Thread(target=process_messages)
     t1.setDaemon(True)
     t1.start()
 
+
+def setup_reconcile_thread():
+    t2 = Thread(target=reconcile_counts_periodically)
+    t2.setDaemon(True)
+    t2.start()
+
+
+def get_heartbeat_counters():
+    return get_event_stats()[0] # Same fields as /stats
+
+
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("config/hair-api-1.0.0-swagger.yaml", strict_validation=True, validate_responses=True)
 
 if __name__ == "__main__":
+    reconcile_counts() # Seed the event counters before the consumer starts updating them
     setup_kafka_thread()
+    setup_reconcile_thread()
+    if HEARTBEAT_ENABLED:
+        setup_heartbeat_thread("storage", get_heartbeat_counters, app_config['heartbeat'])
     app.run(port=8090, host="0.0.0.0") # Receiver is running on port 8080
\ No newline at end of file
@@ -1,5 +1,9 @@
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+import time # For timing pool checkouts
+from threading import Lock
 
 # For creating and displaying log messages (log_conf)
 import logging
@@ -17,10 +21,67 @@ with open("config/log_conf.yaml", "r") as f:
 
 logger = logging.getLogger('basicLogger')
 
+# Connection pool settings
+POOL_CONFIG = app_config['datastore']['pool']
+
+
+# Queue pool that records how long each checkout waited for a connection
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = Lock()
+        self.num_checkouts = 0
+        self.total_wait = 0.0 # Seconds
+        self.max_wait = 0.0 # Seconds
+
+
+    def _do_get(self):
+        start = time.monotonic()
+        connection = super()._do_get()
+        waited = time.monotonic() - start
+        with self.metrics_lock:
+            self.num_checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return connection
+
+
+    def metrics(self):
+        """Returns: dict of pool usage and checkout wait times"""
+        with self.metrics_lock:
+            return {
+                "pool_size": self.size(),
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "num_checkouts": self.num_checkouts,
+                "avg_wait_ms": (self.total_wait / self.num_checkouts * 1000) if self.num_checkouts else 0.0,
+                "max_wait_ms": self.max_wait * 1000
+            }
+
+
 logger.info(f"create_database.py script: MySQL connection string: 'mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}'")
 
-ENGINE = create_engine(f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}", pool_recycle=360)
+ENGINE = create_engine(
+    f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}",
+    poolclass=TimedQueuePool,
+    pool_size=POOL_CONFIG['size'], # Connections kept open
+    max_overflow=POOL_CONFIG['max_overflow'], # Extra connections allowed when the pool is busy
+    pool_timeout=POOL_CONFIG['timeout'], # Seconds to wait for a connection before giving up
+    pool_pre_ping=POOL_CONFIG['pre_ping'], # Check connections are still alive before using them
+    pool_recycle=POOL_CONFIG['recycle'] # Seconds before a connection is replaced
+)
+
+# Made once and shared - creating a sessionmaker is not free
+SESSION_FACTORY = sessionmaker(bind=ENGINE)
+
+# One session per thread for API requests (see use_db_session in app.py)
+ScopedSession = scoped_session(SESSION_FACTORY)
 
 
 def make_session():
-    return sessionmaker(bind=ENGINE)()
+    return SESSION_FACTORY()
+
+
+def get_pool_metrics():
+    return ENGINE.pool.metrics()
@@ -18,4 +18,10 @@ logger = logging.getLogger('basicLogger')
 
 logger.info(f"create_tables.py script: Creating tables")
 
-Base.metadata.create_all(cd.ENGINE)
\ No newline at end of file
+Base.metadata.create_all(cd.ENGINE)
+
+# create_all() skips tables that already exist, so add any indexes they're missing
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        logger.info(f"create_tables.py script: Creating index {index.name} (if it doesn't exist)")
+        index.create(cd.ENGINE, checkfirst=True)
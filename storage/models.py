@@ -1,11 +1,18 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, Float, String, DateTime, func
+from sqlalchemy import Integer, Float, String, DateTime, Index, func
 
 class Base(DeclarativeBase):
     pass
 
 class Volume(Base):
     __tablename__ = "Volume"
+    # Indexes for time range queries (all salons, or a single salon)
+    __table_args__ = (
+        Index("ix_volume_date_created", "date_created"),
+        Index("ix_volume_salon_id_date_created", "salon_id", "date_created"),
+        # Messages re-delivered by Kafka (e.g. after a rebalance) are skipped instead of stored twice
+        Index("ix_volume_trace_id", "trace_id", unique=True),
+    )
     id = mapped_column(Integer, primary_key=True)
     # Data provided by client
     salon_id = mapped_column(String(250), nullable=False)
@@ -37,6 +44,13 @@ class Volume(Base):
 
 class Type(Base):
     __tablename__ = "Type"
+    # Indexes for time range queries (all salons, or a single salon)
+    __table_args__ = (
+        Index("ix_type_date_created", "date_created"),
+        Index("ix_type_salon_id_date_created", "salon_id", "date_created"),
+        # Messages re-delivered by Kafka (e.g. after a rebalance) are skipped instead of stored twice
+        Index("ix_type_trace_id", "trace_id", unique=True),
+    )
     id = mapped_column(Integer, primary_key=True)
     # Data provided by client
     salon_id = mapped_column(String(250), nullable=False)
@@ -65,4 +79,12 @@ class Type(Base):
         # dict['date_created'] = self.date_created
         dict['trace_id'] = self.trace_id
         
-        return dict
\ No newline at end of file
+        return dict
+
+
+# Number of rows in each readings table
+    # Kept up to date by the Kafka consumer in the same transaction as the inserts so /stats doesn't need COUNT(*)
+class EventCount(Base):
+    __tablename__ = "EventCount"
+    table_name = mapped_column(String(250), primary_key=True)
+    count = mapped_column(Integer, nullable=False, default=0)
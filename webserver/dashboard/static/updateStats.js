@@ -1,63 +1,57 @@
 // URLs containing docker container names will be handled in the nginx config file (turn these paths into IP addresses and ports)
-const PROCESSING_STATS_API_URL = "/api/processing/stats" // Stats endpoint for processing (port 8100)
-const ANALYZER_API_URL = {
-    stats: "/api/analyzer/stats", // Stats endpoint for analyzer (port 8110)
-    volume: "/api/analyzer/hair/volume", // Get volume reading at some index endpoint from analyzer
-    type: "/api/analyzer/hair/type" // Get type reading at some index endpoint from analyzer
-}
-const HEALTH_API_URL = "/api/health/statuses"
+// Everything on the dashboard comes from one snapshot built by the health service (port 8120)
+const DASHBOARD_API_URL = "/api/health/dashboard" // Dashboard snapshot endpoint
 // const CHECK_URL = "/api/check/stats"
 
-// This function fetches and updates the general statistics
-const makeReq = (url, cb) => {
-    fetch(url)
-        .then(res => {
-            // Error handling for when my GET request for analyzer when there's no readings (i.e it returns an HTML page like 404 instead of JSON)
-            if (!res.ok) { // if response was unsuccessful (status code not in the 200's)
-                throw new Error(`HTTP ${res.status} from ${url}`)
-            }
-            return res.json()
-        })
-        .then((result) => {
-            console.log("Received data: ", result)
-            cb(result);
-        }).catch((error) => {
-            updateErrorMessages(error.message)
-        })
-}
-
 const updateCodeDiv = (result, elemId) => document.getElementById(elemId).innerText = JSON.stringify(result)
 
 const getLocaleDateStr = () => (new Date()).toLocaleString()
 
-const getStats = () => {
-    document.getElementById("last-updated-value").innerText = getLocaleDateStr()
+// Fills in the page from a dashboard snapshot
+const showSnapshot = (snapshot) => {
+    // Health stats
+    updateCodeDiv(snapshot.statuses.analyzer, "analyzer-status")
+    updateCodeDiv(snapshot.statuses.processing, "processing-status")
+    updateCodeDiv(snapshot.statuses.receiver, "receiver-status")
+    updateCodeDiv(snapshot.statuses.storage, "storage-status")
+    updateCodeDiv(snapshot.statuses.last_update, "last-update")
 
-    // Get health stats
-    makeReq(HEALTH_API_URL, (result) => {
-        updateCodeDiv(result.analyzer, "analyzer-status")
-        updateCodeDiv(result.processing, "processing-status")
-        updateCodeDiv(result.receiver, "receiver-status")
-        updateCodeDiv(result.storage, "storage-status")
-        updateCodeDiv(result.last_update, "last-update")
-    })
-    
-    makeReq(PROCESSING_STATS_API_URL, (result) => updateCodeDiv(result, "processing-stats"))
+    // Services that couldn't be reached keep showing their last values
+    if (snapshot.processing_stats) { updateCodeDiv(snapshot.processing_stats, "processing-stats") }
+    if (snapshot.analyzer_stats) { updateCodeDiv(snapshot.analyzer_stats, "analyzer-stats") }
+    if (snapshot.volume_event) { updateCodeDiv(snapshot.volume_event, "event-volume") }
+    if (snapshot.type_event) { updateCodeDiv(snapshot.type_event, "event-type") }
 
-    makeReq(ANALYZER_API_URL.stats, (result) => {
-        updateCodeDiv(result, "analyzer-stats")
-        let num_volume_readings = result.num_volume_readings // Get number of volume readings from stats
-        let num_type_readings = result.num_type_readings // Get number of type readings from stats
+    snapshot.errors.forEach(updateErrorMessages)
+}
 
-        // Create random indexes (0 to total readings num - 1) for get requests
-        makeReq(`${ANALYZER_API_URL.volume}?index=${Math.floor(Math.random() * Math.abs(num_volume_readings))}`, (result) => {
-            updateCodeDiv(result, "event-volume")
-        })
+// ETag of the snapshot on the page - the health service answers 304 (no body) while it's still current
+let dashboardEtag = null
 
-        makeReq(`${ANALYZER_API_URL.type}?index=${Math.floor(Math.random() * Math.abs(num_type_readings))}`, (result) => {
-            updateCodeDiv(result, "event-type")
+// This function fetches the dashboard snapshot and updates the page if it changed
+const getStats = () => {
+    const headers = dashboardEtag ? { "If-None-Match": dashboardEtag } : {}
+    fetch(DASHBOARD_API_URL, { headers, cache: "no-store" })
+        .then(res => {
+            if (!res.ok && res.status !== 304) { // if response was unsuccessful (status code not in the 200's)
+                throw new Error(`HTTP ${res.status} from ${DASHBOARD_API_URL}`)
+            }
+            // The page is current as of now, whether or not anything changed
+            document.getElementById("last-updated-value").innerText = getLocaleDateStr()
+            if (res.status === 304) {
+                return null // Nothing changed
+            }
+            dashboardEtag = res.headers.get("ETag")
+            return res.json()
+        })
+        .then((snapshot) => {
+            if (snapshot) {
+                console.log("Received data: ", snapshot)
+                showSnapshot(snapshot)
+            }
+        }).catch((error) => {
+            updateErrorMessages(error.message)
         })
-    })
 }
 
 const updateErrorMessages = (message) => {